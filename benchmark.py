@@ -0,0 +1,177 @@
+#********************************** Cargar Librerías ****************************************
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+from pathlib import Path
+from imgspectral import ImgSpectral
+from multispectral import Multispectral
+from imgcatalog import ImgCatalog
+from imgcache import ImgCache
+from imglazy import ImgLazyModule
+
+gd = ImgLazyModule('gdal')
+osr = ImgLazyModule('osgeo.osr')
+
+#****************************** Escenas Sintéticas ******************************************
+
+# Bandas sintéticas por sensor: (nombre de banda, divisor de resolución respecto a la banda más fina)
+SENSORS = {
+    'landsat8' : {
+        'driver' : 'GTiff',
+        'extension' : 'TIF',
+        'pixelSize' : 15.0,
+        'name' : 'LC08_L1TP_010054_20181025_20181025_01_T1_B{}',
+        'bands' : [('1', 2), ('2', 2), ('3', 2), ('4', 2), ('5', 2), ('6', 2), ('7', 2), ('8', 1)],
+        'group' : ['2', '3', '4', '5'],
+    },
+    'sentinel2' : {
+        'driver' : 'JP2OpenJPEG',
+        'extension' : 'jp2',
+        'pixelSize' : 10.0,
+        'name' : 'T18NTL_20181019T153616_B{}',
+        'bands' : [('01', 6), ('02', 1), ('03', 1), ('04', 1), ('08', 1), ('8A', 2), ('11', 2), ('12', 2)],
+        'group' : ['2', '3', '4', '8'],
+    },
+}
+
+# Crea una banda sintética con estructura espacial y ruido reproducible
+def syntheticBand(rng, size):
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)/size
+    smooth = np.sin(6*x + rng.random()*3)*np.cos(5*y + rng.random()*3)
+    noise = rng.normal(0, .08, (size, size))
+    return np.clip(12000 + 8000*(smooth + noise), 1, 65535).astype(np.uint16)
+
+# Escribe la banda con el driver del sensor usando una copia desde memoria
+def writeBand(path, data, driverName, pixelSize):
+    mem = gd.GetDriverByName('MEM').Create('', data.shape[1], data.shape[0], 1, gd.GDT_UInt16)
+    mem.SetGeoTransform((500000.0, pixelSize, 0.0, 1000000.0, 0.0, -pixelSize))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32618)
+    mem.SetProjection(srs.ExportToWkt())
+    mem.GetRasterBand(1).WriteArray(data)
+    options = ['TILED=YES'] if driverName == 'GTiff' else []
+    gd.GetDriverByName(driverName).CreateCopy(str(path), mem, options=options)
+
+# Genera una carpeta de escena con las convenciones de nombres de extensionsConfig
+def makeScene(workdir, sensor, size, seed):
+    config = SENSORS[sensor]
+    if gd.GetDriverByName(config['driver']) is None:
+        print('Driver %s not available, skipping %s' % (config['driver'], sensor))
+        return None
+    folder = Path(workdir)/('%s_%d' % (sensor, size))
+    if folder.exists():
+        return str(folder) + '.' + sensor
+    folder.mkdir(parents = True)
+    rng = np.random.default_rng(seed)
+    for band, divisor in config['bands']:
+        path = folder/(config['name'].format(band) + '.' + config['extension'])
+        writeBand(path, syntheticBand(rng, int(size/divisor)), config['driver'], config['pixelSize']*divisor)
+    return str(folder) + '.' + sensor
+
+#******************************* Mediciones *************************************************
+
+# Ejecuta una operación varias veces y devuelve los tiempos en segundos
+# warmup ejecuta la operación una vez sin medir, para que los casos de caché no midan el fallo inicial
+def measure(operation, repeat, setup = None, warmup = False):
+    if warmup:
+        if not setup is None:
+            setup()
+        operation()
+    times = []
+    for _ in range(repeat):
+        if not setup is None:
+            setup()
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    return times
+
+def clearCache(path):
+    folder = Path('.'.join(path.split('.')[0:-1]))
+    shutil.rmtree(ImgCache.folder(folder, '.imgspectral/cache'), ignore_errors=True)
+    shutil.rmtree(ImgCache.folder(folder, '.multispectral/cache'), ignore_errors=True)
+
+def benchScene(path, sensor, size, factor, repeat):
+    group = SENSORS[sensor]['group']
+    ImgSpectral.resizeFactor = Multispectral.resizeFactor = factor
+    half = int(size/4)
+    loaded = ImgSpectral(path, factor, False).bandsGroup(group[0:3])
+    def render(mode):
+        ImgSpectral.renderMode = Multispectral.renderMode = mode
+        ImgSpectral.color(loaded)
+        Multispectral.composite(loaded[:,:,0], loaded[:,:,1], loaded[:,:,2])
+        ImgSpectral.renderMode = Multispectral.renderMode = 'float'
+    operations = {
+        'imgspectral.cold_load' : (lambda: ImgSpectral(path, factor, False).bandsGroup(group), None, False),
+        'imgspectral.cache_write' : (lambda: ImgSpectral(path, factor, True).bandsGroup(group), lambda: clearCache(path), False),
+        'imgspectral.cache_hit' : (lambda: ImgSpectral(path, factor, True).bandsGroup(group), None, True),
+        'imgspectral.subset' : (lambda: ImgSpectral(path, factor, False, (half, half, 2*half, 2*half), 'pixel').bandsGroup(group), None, False),
+        'imgspectral.band' : (lambda: ImgSpectral(path, factor, False).band(group[0]), None, False),
+        'imgspectral.lazy_window' : (lambda: ImgSpectral(path, factor, False).lazyBandsGroup(group)[0:32, 0:32], None, False),
+        'imgspectral.group_load_workers' : (lambda: ImgSpectral(path, factor, False).bandsGroup(group), None, False),
+        'render.float' : (lambda: render('float'), None, False),
+        'render.lut' : (lambda: render('lut'), None, False),
+        'multispectral.vnir_cold' : (lambda: Multispectral(path, factor, False).vnir(), None, False),
+        'multispectral.vnir_cache_hit' : (lambda: Multispectral(path, factor, True).vnir(), None, True),
+        'multispectral.rgb_cached' : (lambda: Multispectral(path, factor, True).rgb(), None, True),
+    }
+    results = []
+    for name, (operation, setup, warmup) in operations.items():
+        ImgSpectral.workers = len(group) if name.endswith('_workers') else 1
+        times = measure(operation, repeat, setup, warmup)
+        results.append({'sensor' : sensor, 'size' : size, 'factor' : factor, 'operation' : name,
+            'times' : times, 'best' : min(times), 'median' : float(np.median(times))})
+        print('  %-32s factor %3d  best %8.4f s  median %8.4f s' % (name, factor, min(times), np.median(times)))
+    return results
+
+#****************************** Programa Principal ******************************************
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmark de carga, cache y renderizado con escenas sintéticas')
+    parser.add_argument('--sensors', nargs='+', default=list(SENSORS.keys()), choices=list(SENSORS.keys()))
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1200, 2400], help='Lado de la banda más fina en pixeles')
+    parser.add_argument('--factors', nargs='+', type=int, default=[2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='Carpeta para las escenas sintéticas (se reutilizan)')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args(argv)
+
+    gd.UseExceptions()
+    workdir = args.workdir if not args.workdir is None else tempfile.mkdtemp(prefix='imgspectral-bench-')
+    results = []
+    for sensor in args.sensors:
+        for size in args.sizes:
+            path = makeScene(workdir, sensor, size, args.seed)
+            if path is None:
+                continue
+            print('%s %dx%d' % (sensor, size, size))
+            for factor in args.factors:
+                clearCache(path)
+                ImgCatalog.clear()
+                results.append(benchScene(path, sensor, size, factor, args.repeat))
+
+    report = {
+        'meta' : {
+            'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python' : platform.python_version(),
+            'numpy' : np.__version__,
+            'gdal' : gd.__version__,
+            'machine' : platform.machine(),
+            'processor' : platform.processor(),
+            'args' : vars(args),
+        },
+        'results' : [result for scene in results for result in scene],
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to %s' % args.output)
+    return report
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
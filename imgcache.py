@@ -0,0 +1,481 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+import numpy as np
+from pathlib import Path
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class ImgCache:
+
+#********************************* Default Config ************************************
+
+    lockFiles = True        # Bloqueos consultivos entre procesos (fcntl) ademas de los bloqueos entre hilos
+    root = None             # Carpeta central para los caches, None los guarda dentro de la carpeta de cada escena
+    manifest = True         # Registrar las entradas (origen, tipo, forma, tamaño y ultimo acceso) en un manifiesto
+    manifestFile = None     # None usa <root>/manifest.json o un manifest.json en cada carpeta de cache
+    budget = None           # Bytes maximos en disco para todas las entradas del manifiesto, None sin limite
+    touchInterval = 60      # Segundos minimos entre escrituras de los ultimos accesos acumulados
+    journalEntries = 256    # Cambios agregados al diario del manifiesto antes de reescribirlo completo
+    verbose = False
+
+    __threadLocks__ = {}
+    __threadLocksLock__ = threading.Lock()
+    __manifestCache__ = {}
+    __touches__ = {}
+    __touchesLock__ = threading.Lock()
+
+#**********************************  User Methods ***********************************
+
+    @staticmethod
+    def folder(scene, name):
+        if ImgCache.root is None:
+            return Path(scene)/name
+        scene = Path(scene).resolve()
+        return Path(ImgCache.root)/(scene.name + '-' + hashlib.md5(str(scene).encode()).hexdigest()[:12])/name
+
+    @staticmethod
+    def load(path, mmapMode = None, sources = None):
+        path = Path(path)
+        if not path.exists():
+            return None
+        if not ImgCache.valid(path):
+            ImgCache.__print__('Discarding truncated cache %s' % str(path))
+            ImgCache.remove(path)
+            return None
+        if not sources is None and ImgCache.manifest:
+            entry = ImgCache.__entry__(path)
+            if entry is None and not ImgCache.__adopt__(path, sources):
+                # Sin entrada no se puede verificar: es un fallo, y el siguiente save la reemplaza
+                ImgCache.__print__('Ignoring unverified cache %s' % str(path))
+                return None
+            if not entry is None and not ImgCache.__matches__(entry, sources):
+                ImgCache.__print__('Discarding stale cache %s' % str(path))
+                ImgCache.__discardStale__(path, entry)
+                return None
+        try:
+            data = np.load(path, mmap_mode=mmapMode)
+        except (OSError, ValueError):
+            ImgCache.remove(path)
+            return None
+        ImgCache.touch(path)
+        return data
+
+    @staticmethod
+    def save(path, data, sources = None):
+        data = np.asarray(data)
+        path = Path(path)
+        # La entrada se registra antes de reemplazar el archivo, asi un lector sin bloqueo
+        # nunca ve un .npy nuevo sin su entrada en el manifiesto
+        register = None if not ImgCache.manifest else lambda pathTemp: ImgCache.__register__(path, {
+            'size' : os.path.getsize(pathTemp), 'dtype' : data.dtype.str, 'shape' : list(data.shape),
+            'sources' : None if sources is None else ImgCache.fingerprints(sources)})
+        ImgCache.write(path, lambda f: np.save(f, data), register)
+
+    @staticmethod
+    def current(path, sources):
+        if not ImgCache.manifest or ImgCache.__manifestPath__(path) is None:
+            return True
+        entry = ImgCache.__entry__(path)
+        return not entry is None and ImgCache.__matches__(entry, sources)
+
+    @staticmethod
+    def touch(path):
+        manifest = ImgCache.__manifestPath__(path)
+        if not ImgCache.manifest or manifest is None:
+            return
+        # Los accesos se acumulan en memoria y se escriben juntos con el siguiente cambio
+        # del manifiesto, o como maximo una vez cada touchInterval segundos
+        now = time.time()
+        with ImgCache.__touchesLock__:
+            touches = ImgCache.__touches__.setdefault(str(manifest), {'flushed' : now, 'keys' : {}})
+            touches['keys'][ImgCache.__key__(path)] = now
+            due = now - touches['flushed'] >= ImgCache.touchInterval
+        if due:
+            ImgCache.__updateManifest__(lambda entries: 0, manifest)
+
+    @staticmethod
+    def flush():
+        with ImgCache.__touchesLock__:
+            manifests = list(ImgCache.__touches__.keys())
+        for manifest in manifests:
+            ImgCache.__updateManifest__(lambda entries: 0, Path(manifest))
+
+    @staticmethod
+    def remove(path):
+        path = Path(path)
+        ImgCache.discard(path)
+        for sidecar in ImgCache.__sidecars__(path):
+            ImgCache.discard(sidecar)
+        ImgCache.__discardLock__(path)
+        if ImgCache.manifest:
+            key = ImgCache.__key__(path)
+            def update(entries):
+                entry = entries.pop(key, None)
+                return 0 if entry is None else entry['size']
+            ImgCache.__updateManifest__(update, ImgCache.__manifestPath__(path))
+
+    @staticmethod
+    def evict(budget = None, folder = None):
+        budget = ImgCache.budget if budget is None else budget
+        return ImgCache.__updateManifest__(lambda entries: ImgCache.__evict__(entries, budget),
+            ImgCache.__manifestPath__(None if folder is None else Path(folder)/'manifest.json'))
+
+    @staticmethod
+    def clean(folder = None):
+        def update(entries):
+            freed = 0
+            for key in list(entries.keys()):
+                entry = entries[key]
+                try:
+                    stale = not entry['sources'] is None and entry['sources'] != ImgCache.fingerprints(
+                        [source['path'] for source in entry['sources']])
+                except OSError:
+                    stale = True
+                if stale or not Path(key).exists():
+                    freed += ImgCache.__drop__(entries, key)
+            return freed + ImgCache.__evict__(entries, ImgCache.budget)
+        return ImgCache.__updateManifest__(update,
+            ImgCache.__manifestPath__(None if folder is None else Path(folder)/'manifest.json'))
+
+    @staticmethod
+    def fingerprints(paths):
+        fingerprints = []
+        for path in paths:
+            stat = os.stat(path)
+            fingerprints.append({'path' : str(path), 'size' : stat.st_size, 'mtime' : stat.st_mtime_ns})
+        return fingerprints
+
+    @staticmethod
+    def write(path, writer, before = None):
+        path = Path(path)
+        path.parent.mkdir(parents = True, exist_ok=True)
+        pathTemp = path.with_name('%s.%d.%d.tmp' % (path.name, os.getpid(), threading.get_ident()))
+        try:
+            with open(pathTemp, 'wb') as f:
+                writer(f)
+                f.flush()
+                os.fsync(f.fileno())
+            if not before is None:
+                before(pathTemp)
+            os.replace(pathTemp, path)
+        except BaseException:
+            if pathTemp.exists():
+                pathTemp.unlink()
+            raise
+
+    @staticmethod
+    def valid(path):
+        header = ImgCache.__header__(path)
+        if header is None:
+            return False
+        shape, dtype, offset = header
+        if dtype.hasobject:
+            return True
+        return os.path.getsize(path) == offset + int(np.prod(shape))*dtype.itemsize
+
+    @staticmethod
+    def discard(path):
+        try:
+            Path(path).unlink()
+        except OSError:
+            pass
+
+    @staticmethod
+    @contextmanager
+    def lock(path):
+        path = Path(path)
+        with ImgCache.__threadLock__(path):
+            if not ImgCache.lockFiles or fcntl is None:
+                yield
+                return
+            fd = ImgCache.__lockFile__(ImgCache.__lockPath__(path))
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+#******************************** Intern Methods ************************************
+
+    @staticmethod
+    def __header__(path):
+        try:
+            with open(path, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+                return shape, dtype, f.tell()
+        except (OSError, ValueError, EOFError):
+            return None
+
+    @staticmethod
+    def __entry__(path):
+        manifest = ImgCache.__manifestPath__(path)
+        return None if manifest is None else ImgCache.__readManifest__(manifest).get(ImgCache.__key__(path))
+
+    @staticmethod
+    def __matches__(entry, sources):
+        if entry['sources'] is None:
+            return True
+        try:
+            return entry['sources'] == ImgCache.fingerprints(sources)
+        except OSError:
+            return False
+
+    @staticmethod
+    def __register__(path, entry, adopt = False):
+        now = time.time()
+        entry = dict(entry, created=now, accessed=now)
+        key = ImgCache.__key__(path)
+        def update(entries):
+            if adopt:
+                # Otro proceso pudo registrar la entrada mientras tanto
+                entries.setdefault(key, entry)
+                return 0
+            # Reescribir una entrada sin origenes (ej. convertCache) conserva las huellas que ya tenia
+            if entry['sources'] is None and key in entries:
+                entry['sources'] = entries[key]['sources']
+            entries[key] = entry
+            return ImgCache.__evict__(entries, ImgCache.budget, key)
+        return ImgCache.__updateManifest__(update, ImgCache.__manifestPath__(path))
+
+    @staticmethod
+    def __adopt__(path, sources):
+        # Los caches escritos antes del manifiesto se adoptan si el .npy es posterior a todos
+        # sus archivos de origen; si no, no se pueden verificar
+        header = ImgCache.__header__(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            fingerprints = ImgCache.fingerprints(sources)
+        except OSError:
+            return False
+        if header is None or any(fingerprint['mtime'] > mtime for fingerprint in fingerprints):
+            return False
+        ImgCache.__print__('Adopting cache %s' % str(path))
+        ImgCache.__register__(path, {'size' : os.path.getsize(path), 'dtype' : header[1].str,
+            'shape' : list(header[0]), 'sources' : fingerprints}, True)
+        entry = ImgCache.__entry__(path)
+        return not entry is None and ImgCache.__matches__(entry, sources)
+
+    @staticmethod
+    def __discardStale__(path, entry):
+        # Se elimina dentro del bloqueo del manifiesto y solo si la entrada sigue siendo la
+        # obsoleta: un save concurrente registra la nueva entrada antes de reemplazar el archivo
+        key = ImgCache.__key__(path)
+        def update(entries):
+            current = entries.get(key)
+            if current is None or current['created'] != entry['created'] or current['sources'] != entry['sources']:
+                return 0
+            return ImgCache.__drop__(entries, key)
+        ImgCache.__updateManifest__(update, ImgCache.__manifestPath__(path))
+
+    @staticmethod
+    def __lockPath__(path):
+        return path.with_name(path.name + '.lock')
+
+    @staticmethod
+    def __lockFile__(pathLock):
+        while True:
+            pathLock.parent.mkdir(parents = True, exist_ok=True)
+            fd = os.open(str(pathLock), os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            # Si otro proceso elimino el archivo de bloqueo mientras se esperaba, el bloqueo
+            # obtenido es sobre un archivo huerfano y hay que volver a intentarlo
+            try:
+                if os.fstat(fd).st_ino == os.stat(pathLock).st_ino:
+                    return fd
+            except OSError:
+                pass
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @staticmethod
+    def __discardLock__(path):
+        # El archivo de bloqueo solo se elimina si nadie lo tiene: se toma sin esperar y se
+        # borra mientras se tiene, y quien esperaba el inodo borrado vuelve a intentarlo
+        # (los bloqueos de fcntl son por proceso, asi que tampoco puede tenerlo otro hilo)
+        pathLock = ImgCache.__lockPath__(path)
+        if fcntl is None or not pathLock.exists():
+            return
+        with ImgCache.__threadLock__(path, False) as acquired:
+            if not acquired:
+                return
+            try:
+                fd = os.open(str(pathLock), os.O_RDWR)
+            except OSError:
+                return
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return
+            try:
+                if os.fstat(fd).st_ino == os.stat(pathLock).st_ino:
+                    pathLock.unlink()
+            except OSError:
+                pass
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    @staticmethod
+    def __manifestPath__(path = None):
+        # Un manifiesto por carpeta de cache (o uno en root) para no serializar a todos los
+        # procesos de la maquina en un solo archivo por usuario
+        if not ImgCache.manifestFile is None:
+            return Path(ImgCache.manifestFile)
+        if not ImgCache.root is None:
+            return Path(ImgCache.root)/'manifest.json'
+        if path is None:
+            return None
+        return Path(path).parent/'manifest.json'
+
+    @staticmethod
+    def __journalPath__(path):
+        return path.with_name(path.name + '.log')
+
+    @staticmethod
+    def __readManifest__(path):
+        return ImgCache.__readJournal__(path)[0]
+
+    @staticmethod
+    def __readJournal__(path):
+        versions = []
+        for pathFile in (path, ImgCache.__journalPath__(path)):
+            try:
+                stat = os.stat(pathFile)
+                versions.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                versions.append(None)
+        if versions == [None, None]:
+            return {}, 0
+        cached = ImgCache.__manifestCache__.get(str(path))
+        if not cached is None and cached[0] == versions:
+            return cached[1], cached[2]
+        try:
+            with open(path) as f:
+                entries = json.load(f)['entries']
+        except (OSError, ValueError, KeyError):
+            entries = {}
+        # El diario guarda una linea por cambio; una linea incompleta (proceso interrumpido) se ignora
+        changes = 0
+        try:
+            with open(ImgCache.__journalPath__(path)) as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries.update(change['set'])
+                    for key in change['drop']:
+                        entries.pop(key, None)
+                    changes += 1
+        except OSError:
+            pass
+        ImgCache.__manifestCache__[str(path)] = (versions, entries, changes)
+        return entries, changes
+
+    @staticmethod
+    def __updateManifest__(update, path):
+        if path is None:
+            return 0
+        try:
+            with ImgCache.lock(path):
+                current, changes = ImgCache.__readJournal__(path)
+                entries = dict(current)
+                with ImgCache.__touchesLock__:
+                    touches = ImgCache.__touches__.pop(str(path), {'keys' : {}})['keys']
+                for key, accessed in touches.items():
+                    if key in entries and entries[key]['accessed'] < accessed:
+                        entries[key] = dict(entries[key], accessed=accessed)
+                result = update(entries)
+                change = {'set' : {key : entry for key, entry in entries.items() if not current.get(key) is entry},
+                    'drop' : [key for key in current if not key in entries]}
+                if changes >= ImgCache.journalEntries:
+                    ImgCache.write(path, lambda f: f.write(json.dumps({'entries' : entries}).encode()))
+                    ImgCache.discard(ImgCache.__journalPath__(path))
+                elif len(change['set']) > 0 or len(change['drop']) > 0:
+                    path.parent.mkdir(parents = True, exist_ok=True)
+                    with open(ImgCache.__journalPath__(path), 'a') as f:
+                        f.write(json.dumps(change) + '\n')
+                        f.flush()
+                        os.fsync(f.fileno())
+            return result
+        except OSError:
+            ImgCache.__print__('Warning: cache manifest %s not updated' % str(path))
+            return 0
+
+    @staticmethod
+    def __evict__(entries, budget, keep = None):
+        if budget is None:
+            return 0
+        freed = 0
+        total = sum(entry['size'] for entry in entries.values())
+        for key in sorted(entries, key=lambda key: entries[key]['accessed']):
+            if total <= budget:
+                break
+            if key == keep:
+                continue
+            ImgCache.__print__('Evicting cache %s' % key)
+            size = ImgCache.__drop__(entries, key)
+            total -= size
+            freed += size
+        return freed
+
+    @staticmethod
+    def __drop__(entries, key):
+        entry = entries.pop(key)
+        ImgCache.discard(key)
+        for sidecar in ImgCache.__sidecars__(Path(key)):
+            ImgCache.discard(sidecar)
+        ImgCache.__discardLock__(Path(key))
+        return entry['size']
+
+    @staticmethod
+    def __sidecars__(path):
+        name = path.name[:-len('.npy')] if path.name.endswith('.npy') else path.name
+        return [path.with_name(name + '.meta.json'), path.with_name(name + '.stats.json'),
+            path.with_name(name + '.rgb.json')]
+
+    @staticmethod
+    def __key__(path):
+        return str(Path(path).resolve())
+
+    @staticmethod
+    @contextmanager
+    def __threadLock__(path, blocking = True):
+        # Cada bloqueo cuenta sus usuarios y se elimina con el ultimo para no acumular rutas
+        key = str(path.resolve())
+        with ImgCache.__threadLocksLock__:
+            busy = key in ImgCache.__threadLocks__
+            if blocking or not busy:
+                lock = ImgCache.__threadLocks__.setdefault(key, [threading.Lock(), 0])
+                lock[1] += 1
+        if busy and not blocking:
+            yield False
+            return
+        try:
+            with lock[0]:
+                yield True
+        finally:
+            with ImgCache.__threadLocksLock__:
+                lock[1] -= 1
+                if lock[1] == 0:
+                    del ImgCache.__threadLocks__[key]
+
+    @staticmethod
+    def __print__(message):
+        if ImgCache.verbose:
+            print(message)
+
+
+atexit.register(ImgCache.flush)
@@ -0,0 +1,108 @@
+import os
+import json
+from pathlib import Path
+from imgcache import ImgCache
+
+class ImgCatalog:
+
+#********************************* Default Config ************************************
+
+    fileName = '.imgspectral/catalog.json'
+    persist = True
+    verbose = False
+
+    __catalogs__ = {}
+
+#********************************* Constructor **************************************
+
+    def __init__(self, folder, extensions):
+        self.folder = Path(folder)
+        self.extensions = list(extensions)
+        self.files = {}
+        self.dirs = {}
+        self.indexes = {}
+
+#**********************************  User Methods ***********************************
+
+    @staticmethod
+    def get(folder, extensions):
+        key = (str(Path(folder).resolve()), tuple(extensions))
+        catalog = ImgCatalog.__catalogs__.get(key)
+        if catalog is None:
+            catalog = ImgCatalog.__read__(folder, extensions)
+        if catalog is None or not catalog.valid():
+            catalog = ImgCatalog(folder, extensions)
+            catalog.scan()
+        ImgCatalog.__catalogs__[key] = catalog
+        return catalog
+
+    @staticmethod
+    def clear():
+        ImgCatalog.__catalogs__.clear()
+
+    def scan(self):
+        ImgCatalog.__print__('Scanning %s band files...' % self.folder.name)
+        self.files = {ext : [] for ext in self.extensions}
+        self.dirs = {}
+        self.indexes = {}
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            relative = os.path.relpath(root, self.folder)
+            self.dirs[relative] = os.stat(root).st_mtime
+            for name in sorted(files):
+                ext = name.split('.')[-1]
+                if ext in self.files and len(name.split('.')) == 2:
+                    self.files[ext].append(os.path.normpath(os.path.join(relative, name)))
+        self.save()
+
+    def valid(self):
+        try:
+            return all(os.stat(self.folder/relative).st_mtime == mtime for relative, mtime in self.dirs.items())
+        except OSError:
+            return False
+
+    def index(self, key, build):
+        if not key in self.indexes:
+            self.indexes[key] = build(self)
+            self.save()
+        return self.indexes[key]
+
+    def save(self):
+        if not ImgCatalog.persist:
+            return
+        try:
+            path = self.folder/ImgCatalog.fileName
+            if not path.parent.exists():
+                path.parent.mkdir(parents = True, exist_ok=True)
+                if '.' in self.dirs:
+                    self.dirs['.'] = os.stat(self.folder).st_mtime
+            data = json.dumps({'extensions' : self.extensions, 'files' : self.files, 'dirs' : self.dirs,
+                'indexes' : self.indexes})
+            ImgCache.write(path, lambda f: f.write(data.encode()))
+        except OSError:
+            ImgCatalog.__print__('Warning: %s catalog not saved' % self.folder.name)
+
+#******************************** Intern Methods ************************************
+
+    @staticmethod
+    def __read__(folder, extensions):
+        path = Path(folder)/ImgCatalog.fileName
+        if not ImgCatalog.persist or not path.exists():
+            return None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('extensions') != list(extensions):
+            return None
+        catalog = ImgCatalog(folder, extensions)
+        catalog.files = data['files']
+        catalog.dirs = data['dirs']
+        catalog.indexes = data['indexes']
+        return catalog
+
+    @staticmethod
+    def __print__(message):
+        if ImgCatalog.verbose:
+            print(message)
@@ -0,0 +1,94 @@
+import re
+import ast
+import numpy as np
+
+class ImgIndex:
+
+#********************************* Default Config ************************************
+
+    dtype = np.float32
+    bandPattern = re.compile(r'^[Bb](\w+)$')
+    operators = {
+        ast.Add : np.add,
+        ast.Sub : np.subtract,
+        ast.Mult : np.multiply,
+        ast.Div : np.divide,
+        ast.Pow : np.power,
+    }
+
+#********************************* Constructor **************************************
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.bands = []
+        self.program = []
+        self.registers = 0
+        try:
+            tree = ast.parse(expression.strip(), mode='eval')
+        except SyntaxError:
+            raise ValueError('Invalid index expression: %s' % expression)
+        self.__free = []
+        self.result = self.__compile__(tree.body)
+        del self.__free
+        if len(self.bands) == 0:
+            raise ValueError('Index expression uses no band: %s' % expression)
+
+#**********************************  User Methods ***********************************
+
+    def evaluate(self, block, out, buffers = None):
+        rows, cols = out.shape[0:2]
+        if buffers is None:
+            buffers = self.buffers((rows, cols))
+        registers = [buffer[:rows, :cols] for buffer in buffers]
+        operand = lambda o: block[:,:,o[1]] if o[0] == 'band' else (o[1] if o[0] == 'const' else registers[o[1]])
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            if len(self.program) == 0:
+                out[...] = operand(self.result)
+            for i, (op, target, a, b) in enumerate(self.program):
+                target = out if i == len(self.program) - 1 else registers[target]
+                if b is None:
+                    op(operand(a), out=target, dtype=ImgIndex.dtype)
+                else:
+                    op(operand(a), operand(b), out=target, dtype=ImgIndex.dtype)
+        return out
+
+    def buffers(self, shape):
+        return [np.empty(shape, dtype=ImgIndex.dtype) for _ in range(self.registers)]
+
+#******************************** Intern Methods ************************************
+
+    def __compile__(self, node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return ('const', ImgIndex.dtype(node.value))
+        if isinstance(node, ast.Name):
+            match = ImgIndex.bandPattern.match(node.id)
+            if match is None:
+                raise ValueError('Unknown name in index expression: %s' % node.id)
+            band = match.group(1)
+            if not band in self.bands:
+                self.bands.append(band)
+            return ('band', self.bands.index(band))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+            a = self.__compile__(node.operand)
+            if isinstance(node.op, ast.UAdd):
+                return a
+            if a[0] == 'const':
+                return ('const', -a[1])
+            return self.__emit__(np.negative, a, None)
+        if isinstance(node, ast.BinOp) and type(node.op) in ImgIndex.operators:
+            a = self.__compile__(node.left)
+            b = self.__compile__(node.right)
+            return self.__emit__(ImgIndex.operators[type(node.op)], a, b)
+        raise ValueError('Unsupported element in index expression: %s' % ast.dump(node))
+
+    def __emit__(self, op, a, b):
+        for operand in (a, b):
+            if not operand is None and operand[0] == 'reg':
+                self.__free.append(operand[1])
+        if len(self.__free) > 0:
+            target = self.__free.pop()
+        else:
+            target = self.registers
+            self.registers += 1
+        self.program.append((op, target, a, b))
+        return ('reg', target)
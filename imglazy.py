@@ -0,0 +1,31 @@
+import importlib
+import threading
+
+class ImgLazyModule:
+
+#********************************* Constructor **************************************
+
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+        self.__lock = threading.Lock()
+
+#**********************************  User Methods ***********************************
+
+    def load(self):
+        if self.__module is None:
+            with self.__lock:
+                if self.__module is None:
+                    self.__module = importlib.import_module(self.__name)
+        return self.__module
+
+    def loaded(self):
+        return not self.__module is None
+
+#******************************** Intern Methods ************************************
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return '<lazy module %s%s>' % (self.__name, '' if self.__module is None else ' (loaded)')
@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+from imgmetrics import ImgMetrics
+
+class ImgMemoryCache:
+
+#********************************* Constructor **************************************
+
+    def __init__(self, budget = None, metrics = None):
+        self.budget = budget        # Bytes maximos en memoria, None sin limite
+        self.metrics = metrics      # ImgMetrics para registrar aciertos, fallos y desalojos
+        self.__entries = OrderedDict()
+        self.__loading = {}
+        self.__lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+#**********************************  User Methods ***********************************
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                ImgMetrics.count(self.metrics, 'memory.miss')
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+        ImgMetrics.count(self.metrics, 'memory.hit')
+        return entry[0]
+
+    def put(self, key, data):
+        size = ImgMemoryCache.size(data)
+        with self.__lock:
+            self.__pop__(key)
+            if not self.budget is None and size > self.budget:
+                return data
+            self.__entries[key] = (data, size)
+            self.nbytes += size
+            self.evict()
+        return data
+
+    def fetch(self, key, load):
+        data = self.get(key)
+        if not data is None:
+            return data
+        # Una sola carga por llave aunque varios hilos la pidan a la vez
+        with self.__lock:
+            lock = self.__loading.setdefault(key, threading.Lock())
+        with lock:
+            with self.__lock:
+                entry = self.__entries.get(key)
+            if not entry is None:
+                return entry[0]
+            try:
+                return self.put(key, load())
+            finally:
+                with self.__lock:
+                    if self.__loading.get(key) is lock:
+                        del self.__loading[key]
+
+    def peek(self, key):
+        with self.__lock:
+            entry = self.__entries.get(key)
+        return None if entry is None else entry[0]
+
+    def remove(self, key):
+        with self.__lock:
+            return self.__pop__(key)
+
+    def evict(self, budget = None):
+        budget = self.budget if budget is None else budget
+        freed = 0
+        if budget is None:
+            return freed
+        with self.__lock:
+            while self.nbytes > budget and len(self.__entries) > 0:
+                key, (data, size) = self.__entries.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+                freed += size
+                ImgMetrics.count(self.metrics, 'memory.eviction')
+        return freed
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.nbytes = 0
+
+    def keys(self):
+        with self.__lock:
+            return list(self.__entries.keys())
+
+    def snapshot(self):
+        with self.__lock:
+            return {'entries' : len(self.__entries), 'nbytes' : self.nbytes, 'budget' : self.budget,
+                'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions}
+
+    @staticmethod
+    def size(data):
+        return int(getattr(data, 'nbytes', 0))
+
+#******************************** Intern Methods ************************************
+
+    def __pop__(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return 0
+        self.nbytes -= entry[1]
+        return entry[1]
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
@@ -0,0 +1,87 @@
+import time
+import weakref
+import threading
+from contextlib import contextmanager, nullcontext
+
+class ImgMetrics:
+
+#********************************* Constructor **************************************
+
+    def __init__(self, callbacks = None):
+        self.callbacks = [] if callbacks is None else list(callbacks)
+        self.__lock = threading.Lock()
+        self.reset()
+
+#**********************************  User Methods ***********************************
+
+    def reset(self):
+        with self.__lock:
+            self.stages = {}
+            self.counters = {}
+            self.liveAllocation = 0
+            self.peakAllocation = 0
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.__lock:
+                stage = self.stages.setdefault(name, {'count' : 0, 'total' : 0.0, 'max' : 0.0})
+                stage['count'] += 1
+                stage['total'] += elapsed
+                stage['max'] = max(stage['max'], elapsed)
+            self.__emit__('stage', name, elapsed)
+
+    def add(self, name, value = 1):
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.__emit__('counter', name, value)
+
+    def allocation(self, array):
+        # Memoria simultanea de los arrays registrados: se descuenta cuando el array se libera
+        nbytes = int(array.nbytes)
+        with self.__lock:
+            self.liveAllocation += nbytes
+            self.peakAllocation = max(self.peakAllocation, self.liveAllocation)
+        weakref.finalize(array, self.__release__, nbytes)
+        self.__emit__('allocation', 'array', nbytes)
+
+    def snapshot(self):
+        with self.__lock:
+            return {
+                'stages' : {name : dict(stage) for name, stage in self.stages.items()},
+                'counters' : dict(self.counters),
+                'liveAllocation' : self.liveAllocation,
+                'peakAllocation' : self.peakAllocation,
+            }
+
+    @staticmethod
+    def timer(metrics, name):
+        return nullcontext() if metrics is None else metrics.stage(name)
+
+    @staticmethod
+    def count(metrics, name, value = 1):
+        if not metrics is None:
+            metrics.add(name, value)
+
+    @staticmethod
+    def allocated(metrics, array):
+        if not metrics is None:
+            metrics.allocation(array)
+
+#******************************** Intern Methods ************************************
+
+    def __release__(self, nbytes):
+        with self.__lock:
+            # Un reset entre la reserva y la liberacion no debe dejar el contador negativo
+            self.liveAllocation = max(0, self.liveAllocation - nbytes)
+
+    def __emit__(self, kind, name, value):
+        for callback in self.callbacks:
+            callback(kind, name, value)
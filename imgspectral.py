@@ -1,15 +1,37 @@
 import numpy as np
-import gdal as gd
 from pathlib import Path
-from osgeo import ogr
-from osgeo import osr
 from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from imgstats import ImgStats
+from imgcatalog import ImgCatalog
+from imgindex import ImgIndex
+from imgmetrics import ImgMetrics
+from imgcache import ImgCache
+import json
+import hashlib
+import asyncio
+import threading
+from contextlib import nullcontext, ExitStack
+from imglazy import ImgLazyModule
+
+gd = ImgLazyModule('gdal')
+ogr = ImgLazyModule('osgeo.ogr')
+osr = ImgLazyModule('osgeo.osr')
 
 class ImgBand(np.ndarray):
 
-    def __make__(self, dataset, resizeFactor, subset, subsetMode, verbose):
+    loadStrategy = 'mean'   # 'mean', 'decoder' o 'auto'
+    storeDtype = np.float64
+    computeDtype = np.float64
+    metrics = None
+    reference = 0           # Indice del dataset que define la grilla comun
+
+    def __make__(self, dataset, resizeFactor, subset, subsetMode, verbose, **options):
+        for name, value in options.items():
+            if not value is None : setattr(self, name, value)
         self.verbose = verbose
         self.dataset = dataset
+        self.paths = None
         self.resizeFactor = int(resizeFactor)
         self.subset = subset
         self.subsetMode = subsetMode
@@ -18,24 +40,102 @@ class ImgBand(np.ndarray):
         self.__verifyShapes__()
     
     @staticmethod
-    def make(dataset, resizeFactor, subset=None, subsetMode = 'latlon', verbose=False, cache=None):
+    def make(dataset, resizeFactor, subset=None, subsetMode = 'latlon', verbose=False, cache=None, **options):
         if cache is None:
-            imgBand = ImgBand(0)
-            imgBand.__make__(dataset, resizeFactor, subset, subsetMode, verbose)    
+            imgBand = ImgBand(0, dtype=options.get('storeDtype') or ImgBand.storeDtype)
+            imgBand.__make__(dataset, resizeFactor, subset, subsetMode, verbose, **options)    
             imgBand.resize(imgBand.factorShape, refcheck=False)
+            ImgMetrics.allocated(imgBand.metrics, imgBand)
             imgBand.__load__()
         else:
             imgBand = ImgBand(cache.shape, dtype=cache.dtype, buffer=cache, offset=0)
-            imgBand.__make__(dataset, resizeFactor, subset, subsetMode, verbose)
+            imgBand.__make__(dataset, resizeFactor, subset, subsetMode, verbose, **options)
         return imgBand
     
+    @staticmethod
+    def geometry(datasets, resizeFactor, subset=None, subsetMode = 'latlon', verbose=False, **options):
+        dtype = options.get('storeDtype') or ImgBand.storeDtype
+        if len(datasets) == 1:
+            imgBand = ImgBand(0, dtype=dtype)
+        else:
+            ImgBandsGroup.__verifyDatasets__(datasets)
+            imgBand = ImgBandsGroup(0, dtype=dtype)
+            imgBand.datasets = datasets
+            imgBand.workers = 1
+        imgBand.__make__(datasets[0], resizeFactor, subset, subsetMode, verbose, **options)
+        return imgBand
+
+    @staticmethod
+    def fromCache(cache, meta, paths, verbose=False, workers = 1, **options):
+        if len(cache.shape) == 2:
+            imgBand = ImgBand(cache.shape, dtype=cache.dtype, buffer=cache, offset=0)
+        else:
+            imgBand = ImgBandsGroup(cache.shape, dtype=cache.dtype, buffer=cache, offset=0)
+            imgBand.datasets = None
+            imgBand.workers = workers
+        for name, value in options.items():
+            if not value is None : setattr(imgBand, name, value)
+        imgBand.verbose = verbose
+        imgBand.dataset = None
+        imgBand.paths = [str(path) for path in paths]
+        imgBand.resizeFactor = int(meta['resizeFactor'])
+        imgBand.subset = None if meta['subset'] is None else tuple(meta['subset'])
+        imgBand.subsetMode = meta['subsetMode']
+        imgBand.geoTransform = tuple(meta['geoTransform'])
+        imgBand.projection = meta['projection']
+        imgBand.rasterShape = tuple(meta['rasterShape'])
+        imgBand.realSubset = tuple(meta['realSubset'])
+        imgBand.factorShape = tuple(meta['factorShape'])
+        imgBand.reference = int(meta.get('reference', 0))
+        imgBand.bandGeoTransforms = None if meta.get('bandGeoTransforms') is None else [tuple(gt) for gt in meta['bandGeoTransforms']]
+        imgBand.__transforms = None
+        return imgBand
+
+    def describe(self):
+        values = lambda v: None if v is None else [i.item() if isinstance(i, np.generic) else i for i in v]
+        return {'resizeFactor' : self.resizeFactor, 'subset' : values(self.subset), 'subsetMode' : self.subsetMode,
+            'geoTransform' : values(self.geoTransform), 'projection' : self.projection, 
+            'rasterShape' : values(self.rasterShape), 'realSubset' : values(self.realSubset), 
+            'factorShape' : values(self.factorShape), 'shape' : list(self.shape), 'dtype' : self.dtype.str,
+            'reference' : self.reference, 'bandGeoTransforms' : None if getattr(self, 'bandGeoTransforms', None) is None else
+                [values(gt) for gt in self.bandGeoTransforms]}
+
+    @property
+    def dataset(self):
+        if self.__dataset is None:
+            self.__dataset = gd.Open(self.paths[self.reference])
+        return self.__dataset
+
+    @dataset.setter
+    def dataset(self, dataset):
+        self.__dataset = dataset
+
+    def close(self):
+        if self.paths is None:
+            # La ruta queda en la posicion de la referencia para poder reabrir el dataset
+            self.paths = [None]*self.reference + [self.__dataset.GetDescription()]
+        self.__dataset = None
+
+    @property
+    def transToLatLon(self):
+        return self.__coordinateTransforms__()[0]
+
+    @property
+    def transToXY(self):
+        return self.__coordinateTransforms__()[1]
+
+    def __coordinateTransforms__(self):
+        if self.__transforms is None:
+            source = osr.SpatialReference()
+            source.ImportFromWkt(self.projection)
+            target = source.CloneGeogCS()
+            self.__transforms = (osr.CoordinateTransformation(source, target), osr.CoordinateTransformation(target, source))
+        return self.__transforms
+
     def __generateCoordinateSystem__(self):
         self.geoTransform = self.dataset.GetGeoTransform()
-        source = osr.SpatialReference()
-        source.ImportFromWkt(self.dataset.GetProjection())
-        target = source.CloneGeogCS()
-        self.transToLatLon = osr.CoordinateTransformation(source, target)
-        self.transToXY = osr.CoordinateTransformation(target, source)    
+        self.projection = self.dataset.GetProjection()
+        self.__transforms = None
 
     def __xy2pixel__(self, xy):
         gt = self.geoTransform
@@ -57,31 +157,143 @@ class ImgBand(np.ndarray):
             return
         if self.subsetMode == 'latlon':
             ss_center = self.__xy2pixel__(self.transToXY.TransformPoint(self.subset[1], self.subset[0]))
-            ss_width = self.__width2size__(self.subset[2])
-            while ss_width%2 == 0 or ss_width%self.resizeFactor != 0:
-                ss_width += 1
-            ss_heigth = self.__height2size__(self.subset[3])
-            while ss_heigth%2 == 0 or ss_heigth%self.resizeFactor != 0:
-                ss_heigth += 1
+            # Tamaños multiplos del factor; con factor impar ademas impares para centrar la ventana
+            # en el pixel central (con factor par ningun multiplo es impar)
+            ss_width = ImgBand.__subsetSize__(self.__width2size__(self.subset[2]), self.resizeFactor)
+            ss_heigth = ImgBand.__subsetSize__(self.__height2size__(self.subset[3]), self.resizeFactor)
             self.factorShape = (int(ss_heigth/self.resizeFactor), int(ss_width/self.resizeFactor))
-            self.realSubset = (ss_center[0]-(ss_heigth-1)/2, ss_center[1]-(ss_width-1)/2) + (ss_width, ss_heigth)
+            self.realSubset = (int(ss_center[0] - ss_width//2), int(ss_center[1] - ss_heigth//2), ss_width, ss_heigth)
             self.__print__("Real subset: {}".format(str(self.realSubset)))
+        elif self.subsetMode == 'pixel':
+            f = self.resizeFactor
+            ss_width = int(np.ceil(self.subset[2]/f))*f
+            ss_heigth = int(np.ceil(self.subset[3]/f))*f
+            # La ventana se recorta al raster
+            ss_width = min(ss_width, int((rasterShape[1] - int(self.subset[0]))/f)*f)
+            ss_heigth = min(ss_heigth, int((rasterShape[0] - int(self.subset[1]))/f)*f)
+            self.factorShape = (int(ss_heigth/self.resizeFactor), int(ss_width/self.resizeFactor))
+            self.realSubset = (int(self.subset[0]), int(self.subset[1]), ss_width, ss_heigth)
         else :
             raise ValueError("Invalid subset Mode")
 
+    @staticmethod
+    def __subsetSize__(size, f):
+        size = max(int(size), 1)
+        while size%f != 0 or (f%2 == 1 and size%2 == 0):
+            size += 1
+        return size
+
     def __verifyShapes__(self):
-        pass
+        x, y, width, heigth = self.realSubset
+        if x < 0 or y < 0 or width <= 0 or heigth <= 0 or x + width > self.rasterShape[1] or y + heigth > self.rasterShape[0]:
+            raise ValueError("Subset out of raster bounds: {}".format(str(self.realSubset)))
 
-    def __areaMean__(self, a):
-        f = self.resizeFactor
+    def __areaMean__(self, a, factor = None):
+        f = self.resizeFactor if factor is None else factor
         a0 = a.reshape((a.shape[0], a.shape[1], int(a.size/(a.shape[0]*a.shape[1]))), order='F')
         a1 = a.reshape((a0.shape[0], f, int(a0.shape[1]*a0.shape[2]/f)), order='F')
         a2 = np.transpose(a1,axes=[1,0,2]).reshape((int(f**2),int(a0.size/(f**2))), order='F')
-        a3 = a2.mean(axis=0).reshape((int(a0.shape[0]/f), int(a0.shape[1]/f), a0.shape[2]), order='F')
+        a3 = a2.mean(axis=0, dtype=self.computeDtype).reshape((int(a0.shape[0]/f), int(a0.shape[1]/f), a0.shape[2]), order='F')
         return a3.reshape(a3.shape[0:len(a.shape)])
 
-    def __refactor__(self, raw, row):
-        self[row : row + int(raw.shape[0]/self.resizeFactor),:] = self.__areaMean__(raw)
+    def __refactor__(self, data, row):
+        self[row : row + data.shape[0],:] = data
+
+    def __read__(self, dataset, xoff, yoff, xsize, ysize, factor = None):
+        f = self.resizeFactor if factor is None else factor
+        if f > 1 and self.__useDecoder__(dataset, f):
+            return self.__resample__(dataset, xoff, yoff, xsize, ysize, int(ysize/f), int(xsize/f))
+        with ImgMetrics.timer(self.metrics, 'decode'):
+            raw = dataset.ReadAsArray(int(xoff), int(yoff), int(xsize), int(ysize))
+        ImgMetrics.count(self.metrics, 'gdal.bytesRead', raw.nbytes)
+        with ImgMetrics.timer(self.metrics, 'reduce'):
+            data = raw if f == 1 else self.__areaMean__(raw, f)
+        return ImgBand.__store__(data, self.storeDtype)
+
+    def __resample__(self, dataset, xoff, yoff, xsize, ysize, rows, cols):
+        window = np.array((xoff, yoff, xsize, ysize), dtype=np.float64)
+        x0, y0, x1, y1 = [int(v) for v in np.round((xoff, yoff, xoff + xsize, yoff + ysize))]
+        if not np.allclose(window, np.round(window), rtol=0, atol=1e-6) or x0 < 0 or y0 < 0 or \
+            x1 > dataset.RasterXSize or y1 > dataset.RasterYSize:
+            return self.__resampleArea__(dataset, xoff, yoff, xsize, ysize, rows, cols)
+        bufType = gd.GDT_Float32 if np.dtype(self.computeDtype) == np.float32 else gd.GDT_Float64
+        with ImgMetrics.timer(self.metrics, 'decode'):
+            data = dataset.ReadAsArray( x0, y0, x1 - x0, y1 - y0, buf_xsize=int(cols), buf_ysize=int(rows),
+                                        buf_type=bufType, resample_alg=gd.GRIORA_Average)
+        if not self.metrics is None:
+            ImgMetrics.count(self.metrics, 'gdal.bytesRead', ImgBand.__windowBytes__(dataset, x1 - x0, y1 - y0))
+        return ImgBand.__store__(data, self.storeDtype)
+
+    def __resampleArea__(self, dataset, xoff, yoff, xsize, ysize, rows, cols):
+        # Ventanas con bordes fraccionarios (bandas de otra resolucion, escenas desplazadas):
+        # se lee la ventana entera que la contiene y se promedia por area exacta, en lugar de
+        # redondear la ventana y estirarla sobre la salida
+        x0 = max(0, int(np.floor(xoff + 1e-6)))
+        y0 = max(0, int(np.floor(yoff + 1e-6)))
+        x1 = min(dataset.RasterXSize, int(np.ceil(xoff + xsize - 1e-6)))
+        y1 = min(dataset.RasterYSize, int(np.ceil(yoff + ysize - 1e-6)))
+        with ImgMetrics.timer(self.metrics, 'decode'):
+            raw = dataset.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+        ImgMetrics.count(self.metrics, 'gdal.bytesRead', raw.nbytes)
+        with ImgMetrics.timer(self.metrics, 'reduce'):
+            data = ImgBand.__areaResample__(raw, yoff - y0, ysize/rows, int(rows), 0)
+            data = ImgBand.__areaResample__(data, xoff - x0, xsize/cols, int(cols), 1)
+        return ImgBand.__store__(data.astype(self.computeDtype, copy=False), self.storeDtype)
+
+    @staticmethod
+    def __areaResample__(data, start, step, out, axis):
+        # Integral acumulada de la señal constante por pixel evaluada en los bordes de cada celda;
+        # las partes de una celda fuera del raster no cuentan en su promedio
+        data = np.moveaxis(np.asarray(data, dtype=np.float64), axis, 0)
+        n = data.shape[0]
+        cumulative = np.concatenate((np.zeros((1,) + data.shape[1:]), np.cumsum(data, axis=0)))
+        edges = np.clip(start + step*np.arange(out + 1), 0, n)
+        index = np.minimum(np.floor(edges).astype(int), n - 1)
+        fraction = (edges - index).reshape((out + 1,) + (1,)*(data.ndim - 1))
+        integral = cumulative[index] + fraction*data[index]
+        widths = (edges[1:] - edges[:-1]).reshape((out,) + (1,)*(data.ndim - 1))
+        result = np.divide(integral[1:] - integral[:-1], widths, out=np.zeros((out,) + data.shape[1:]), where=widths > 0)
+        return np.moveaxis(result, 0, axis)
+
+    @staticmethod
+    def __windowBytes__(dataset, xsize, ysize):
+        # Bytes de la ventana de origen, no del buffer reducido que devuelve GDAL
+        return int(xsize)*int(ysize)*int(gd.GetDataTypeSize(dataset.GetRasterBand(1).DataType)/8)
+
+    @staticmethod
+    def __store__(data, dtype):
+        if np.issubdtype(dtype, np.integer) and not np.can_cast(data.dtype, dtype):
+            # Redondear y saturar en el rango del tipo entero en lugar de desbordar
+            if not np.issubdtype(data.dtype, np.integer):
+                data = np.rint(data)
+            data = np.clip(data, np.iinfo(dtype).min, np.iinfo(dtype).max)
+        return data.astype(dtype, copy=False)
+
+    def __useDecoder__(self, dataset, factor = None):
+        f = self.resizeFactor if factor is None else factor
+        if self.loadStrategy == 'mean':
+            return False
+        if self.loadStrategy == 'decoder':
+            return True
+        if self.loadStrategy != 'auto':
+            raise ValueError("Invalid load strategy")
+        if f & (f - 1) != 0:
+            return False
+        return dataset.GetDriver().ShortName.startswith('JP2') or dataset.GetRasterBand(1).GetOverviewCount() > 0
+
+    def __loadWindow__(self, rows, cols):
+        self[rows[0] : rows[1], cols[0] : cols[1]] = self.__readWindow__(rows, cols)
+
+    def __readWindow__(self, rows, cols, dataset = None):
+        f = self.resizeFactor
+        dataset = self.dataset if dataset is None else dataset
+        return self.__read__(   dataset, self.realSubset[0] + cols[0]*f, self.realSubset[1] + rows[0]*f,
+                                (cols[1] - cols[0])*f, (rows[1] - rows[0])*f)
+
+    def __windowGeoTransform__(self, row, col):
+        gt, f = self.geoTransform, self.resizeFactor
+        x, y = self.realSubset[0] + col*f, self.realSubset[1] + row*f
+        return (gt[0] + x*gt[1] + y*gt[2], gt[1]*f, gt[2]*f, gt[3] + x*gt[4] + y*gt[5], gt[4]*f, gt[5]*f)
 
     def __print__(self, str, end='\n'):
         if self.verbose:
@@ -90,17 +302,17 @@ class ImgBand(np.ndarray):
     def __load__(self):
         max_load_memory = 1250000
         load_block_rows = int(max_load_memory/self.realSubset[2])
-        load_block_rows -= load_block_rows%self.resizeFactor
+        load_block_rows = max(self.resizeFactor, load_block_rows - load_block_rows%self.resizeFactor)
         load_block = [min(int(load_block_rows), self.realSubset[3]), self.realSubset[2]]
         row = int(0)
         while row < self.factorShape[0]:
-            raw = self.dataset.ReadAsArray( int(self.realSubset[0]), 
-                                            int(self.realSubset[1] + row*self.resizeFactor), 
-                                            int(load_block[1]), int(load_block[0]))
-            self.__refactor__(raw, row)
+            data = self.__read__(   self.dataset, self.realSubset[0], 
+                                    self.realSubset[1] + row*self.resizeFactor, 
+                                    load_block[1], load_block[0])
+            self.__refactor__(data, row)
             row += int(load_block[0]/self.resizeFactor)    
-            if row*self.resizeFactor + load_block[0] > self.rasterShape[0]:
-                load_block[0] = (self.factorShape[0] - row)*self.resizeFactor
+            # El ultimo bloque se acorta a las filas que quedan del subset
+            load_block[0] = min(load_block[0], (self.factorShape[0] - row)*self.resizeFactor)
             loaded = (row/self.factorShape[0])
             self.__print__('  loaded {:.0f} %'.format(loaded*100.0), end = '\r')
         self.__print__("                                          ", end='\r')
@@ -109,49 +321,234 @@ class ImgBand(np.ndarray):
 class ImgBandsGroup(ImgBand):
 
     @staticmethod
-    def make(datasets, resizeFactor, subset=None, subsetMode='latlon', verbose=False, cache = None):
+    def make(datasets, resizeFactor, subset=None, subsetMode='latlon', verbose=False, cache = None, workers = 1, **options):
         ImgBandsGroup.__verifyDatasets__(datasets)
         if cache is None:
-            imgBandsGroup = ImgBandsGroup(0)
+            imgBandsGroup = ImgBandsGroup(0, dtype=options.get('storeDtype') or ImgBand.storeDtype)
             imgBandsGroup.datasets = datasets
-            imgBandsGroup.__make__(datasets[0], resizeFactor, subset, subsetMode, verbose)
+            imgBandsGroup.workers = workers
+            imgBandsGroup.__make__(datasets[0], resizeFactor, subset, subsetMode, verbose, **options)
             imgBandsGroup.resize(imgBandsGroup.factorShape + (len(datasets),), refcheck=False)
+            ImgMetrics.allocated(imgBandsGroup.metrics, imgBandsGroup)
             imgBandsGroup.__load__()
         else:
             imgBandsGroup = ImgBandsGroup(cache.shape, dtype=cache.dtype, buffer=cache, offset=0)
             imgBandsGroup.datasets = datasets
-            imgBandsGroup.__make__(datasets[0], resizeFactor, subset, subsetMode, verbose)
+            imgBandsGroup.workers = workers
+            imgBandsGroup.__make__(datasets[0], resizeFactor, subset, subsetMode, verbose, **options)
         return imgBandsGroup
 
+    @property
+    def datasets(self):
+        if self.__datasets is None:
+            self.__datasets = [self.dataset if i == self.reference else gd.Open(path) for i, path in enumerate(self.paths)]
+        return self.__datasets
+
+    @datasets.setter
+    def datasets(self, datasets):
+        self.__datasets = datasets
+
+    def close(self):
+        if self.paths is None:
+            self.paths = [dataset.GetDescription() for dataset in self.__datasets]
+        self.__datasets = None
+        ImgBand.close(self)
+
+    def __make__(self, dataset, resizeFactor, subset, subsetMode, verbose, **options):
+        self.reference = ImgBandsGroup.__reference__(self.datasets)
+        self.bandGeoTransforms = [tuple(ds.GetGeoTransform()) for ds in self.datasets]
+        ImgBand.__make__(self, self.datasets[self.reference], resizeFactor, subset, subsetMode, verbose, **options)
+
+    @staticmethod
+    def __reference__(datasets):
+        sizes = [abs(ds.GetGeoTransform()[1]) for ds in datasets]
+        return sizes.index(min(sizes))
+
     @staticmethod
     def __verifyDatasets__(datasets):
-        pass
+        reference = datasets[ImgBandsGroup.__reference__(datasets)]
+        rgt = reference.GetGeoTransform()
+        rextent = np.array((rgt[0], rgt[3], rgt[0] + reference.RasterXSize*rgt[1], rgt[3] + reference.RasterYSize*rgt[5]))
+        for ds in datasets:
+            gt = ds.GetGeoTransform()
+            extent = np.array((gt[0], gt[3], gt[0] + ds.RasterXSize*gt[1], gt[3] + ds.RasterYSize*gt[5]))
+            if gt[2] != rgt[2] or gt[4] != rgt[4] or np.any(np.abs(extent - rextent) > abs(gt[1])):
+                raise ValueError('Datasets extents not match: %s, %s' % (ds.GetDescription(), reference.GetDescription()))
+
+    def __refactor__(self, data, row, band):
+        self[row : row + data.shape[0],:,band] = data
+
+    def __loadWindow__(self, rows, cols):
+        self[rows[0] : rows[1], cols[0] : cols[1]] = self.__readWindow__(rows, cols)
 
-    def __refactor__(self, raw, row, band):
-        self[row : row + int(raw.shape[0]/self.resizeFactor),:,band] = self.__areaMean__(raw)
+    def __readBand__(self, band, xoff, yoff, xsize, ysize):
+        dataset = self.datasets[band]
+        gt, rgt = self.bandGeoTransforms[band], self.bandGeoTransforms[self.reference]
+        ratio = abs(gt[1]/rgt[1])
+        if ratio == 1 and gt[0] == rgt[0] and gt[3] == rgt[3]:
+            return self.__read__(dataset, xoff, yoff, xsize, ysize)
+        # Ventana en pixeles propios de la banda, reducida a su factor efectivo
+        bxoff = (rgt[0] + xoff*rgt[1] - gt[0])/gt[1]
+        byoff = (rgt[3] + yoff*rgt[5] - gt[3])/gt[5]
+        f = self.resizeFactor/ratio
+        window = np.array((bxoff, byoff, xsize/ratio, ysize/ratio, f))
+        aligned = np.allclose(window, np.round(window), rtol=0, atol=1e-6) and round(f) >= 1
+        bxoff, byoff, bxsize, bysize, f = [int(v) for v in np.round(window)]
+        if aligned and bxoff >= 0 and byoff >= 0 and bxoff + bxsize <= dataset.RasterXSize and byoff + bysize <= dataset.RasterYSize:
+            return self.__read__(dataset, bxoff, byoff, bxsize, bysize, f)
+        bxoff, byoff = window[0:2]
+        return self.__resample__(dataset, bxoff, byoff, xsize/ratio, ysize/ratio, int(ysize/self.resizeFactor), int(xsize/self.resizeFactor))
+
+    def __readWindow__(self, rows, cols):
+        f = self.resizeFactor
+        out = None
+        for band in range(len(self.datasets)):
+            data = self.__readBand__(   band, self.realSubset[0] + cols[0]*f, self.realSubset[1] + rows[0]*f,
+                                        (cols[1] - cols[0])*f, (rows[1] - rows[0])*f)
+            if out is None:
+                out = np.empty(data.shape + (len(self.datasets),), dtype=data.dtype)
+            out[:,:,band] = data
+        return out
 
     def __load__(self):
+        workers = min(self.workers, len(self.datasets))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for band in executor.map(self.__loadDataset__, range(len(self.datasets))):
+                    self.__print__('  loaded band {}'.format(band))
+        else:
+            for band in range(len(self.datasets)):
+                self.__loadDataset__(band)
+        self.__print__("                                              ", end='\r')
+
+    def __loadDataset__(self, band):
         max_load_memory = 1250000
         load_block_rows = int(max_load_memory/self.realSubset[2])
-        load_block_rows -= load_block_rows%self.resizeFactor
-        for band in range(len(self.datasets)):
-            dataset = self.datasets[band]
-            load_block = [min(int(load_block_rows), self.realSubset[3]), self.realSubset[2]]
-            row = int(0)
-            while row < self.factorShape[0]:
-                raw = dataset.ReadAsArray(  int(self.realSubset[0]), 
-                                            int(self.realSubset[1] + row*self.resizeFactor), 
-                                            int(load_block[1]), int(load_block[0]))
-                self.__refactor__(raw, row, band)
-                row += int(load_block[0]/self.resizeFactor)    
-                if row*self.resizeFactor + load_block[0] > self.rasterShape[0]:
-                    load_block[0] = (self.factorShape[0] - row)*self.resizeFactor
+        load_block_rows = max(self.resizeFactor, load_block_rows - load_block_rows%self.resizeFactor)
+        load_block = [min(int(load_block_rows), self.realSubset[3]), self.realSubset[2]]
+        row = int(0)
+        while row < self.factorShape[0]:
+            data = self.__readBand__(   band, self.realSubset[0], 
+                                    self.realSubset[1] + row*self.resizeFactor, 
+                                    load_block[1], load_block[0])
+            self.__refactor__(data, row, band)
+            row += int(load_block[0]/self.resizeFactor)    
+            # El ultimo bloque se acorta a las filas que quedan del subset
+            load_block[0] = min(load_block[0], (self.factorShape[0] - row)*self.resizeFactor)
+            if self.workers <= 1:
                 loaded = (band + row/self.factorShape[0])/len(self.datasets)
                 self.__print__('  loaded {:.0f} %'.format(loaded*100.0), end = '\r')
-        self.__print__("                                              ", end='\r')
+        return band
             
 
 
+class LazyImgBand:
+
+    blockShape = (64, 64)
+
+    def __init__(self, imgBand):
+        self.imgBand = imgBand
+        self.shape = imgBand.shape
+        self.dtype = imgBand.dtype
+        self.ndim = imgBand.ndim
+        blocks = np.ceil(np.array(self.shape[0:2])/np.array(LazyImgBand.blockShape)).astype(int)
+        self.filled = np.zeros(tuple(blocks), dtype=bool)
+
+    @staticmethod
+    def make(dataset, resizeFactor, subset=None, subsetMode = 'latlon', verbose=False, **options):
+        imgBand = ImgBand.geometry([dataset], resizeFactor, subset, subsetMode, verbose, **options)
+        imgBand.resize(imgBand.factorShape, refcheck=False)
+        return LazyImgBand(imgBand)
+
+    @staticmethod
+    def makeGroup(datasets, resizeFactor, subset=None, subsetMode = 'latlon', verbose=False, **options):
+        imgBandsGroup = ImgBand.geometry(datasets, resizeFactor, subset, subsetMode, verbose, **options)
+        imgBandsGroup.resize(imgBandsGroup.factorShape + (len(datasets),), refcheck=False)
+        return LazyImgBand(imgBandsGroup)
+
+    def load(self):
+        self.__fill__((0, self.shape[0]), (0, self.shape[1]))
+        return self.imgBand
+
+    def __getitem__(self, key):
+        keys = key if isinstance(key, tuple) else (key,)
+        if any(k is Ellipsis or k is None for k in keys):
+            keys = ()
+        self.__fill__(self.__window__(keys, 0), self.__window__(keys, 1))
+        return self.imgBand.view(np.ndarray)[key]
+
+    def __array__(self, dtype = None, copy = None):
+        self.load()
+        return np.asarray(self.imgBand.view(np.ndarray), dtype=dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getattr__(self, name):
+        if name == 'imgBand' or name.startswith('__array'):
+            raise AttributeError(name)
+        return getattr(self.imgBand, name)
+
+    def __window__(self, keys, axis):
+        n = self.shape[axis]
+        if len(keys) <= axis:
+            return (0, n)
+        key = keys[axis]
+        if isinstance(key, (int, np.integer)):
+            index = int(key) + n if key < 0 else int(key)
+            return (index, index + 1)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(n)
+            if step < 0:
+                start, stop = stop + 1, start + 1
+            return (start, max(start, stop))
+        return (0, n)
+
+    def __fill__(self, rows, cols):
+        bh, bw = LazyImgBand.blockShape
+        rows = (max(0, rows[0]), min(self.shape[0], rows[1]))
+        cols = (max(0, cols[0]), min(self.shape[1], cols[1]))
+        if rows[0] >= rows[1] or cols[0] >= cols[1]:
+            return
+        c0, c1 = int(cols[0]/bw), int(np.ceil(cols[1]/bw))
+        for br in range(int(rows[0]/bh), int(np.ceil(rows[1]/bh))):
+            bc = c0
+            while bc < c1:
+                if self.filled[br, bc]:
+                    bc += 1
+                    continue
+                end = bc
+                while end < c1 and not self.filled[br, end]:
+                    end += 1
+                self.imgBand.__loadWindow__((br*bh, min((br + 1)*bh, self.shape[0])),
+                                            (bc*bw, min(end*bw, self.shape[1])))
+                self.filled[br, bc:end] = True
+                bc = end
+
+
+class ImgSceneHandle:
+
+    def __init__(self, path, bands, resizeFactor):
+        self.path = path
+        self.bands = [str(band) for band in bands]
+        self.resizeFactor = resizeFactor
+        self.cachePath = None
+        self.shape = None
+        self.dtype = None
+        self.error = None
+
+    def load(self, mmapMode = 'r'):
+        if not self.error is None:
+            raise self.error
+        return np.load(self.cachePath, mmap_mode=mmapMode)
+
+    def image(self):
+        return ImgSpectral(self.path, self.resizeFactor, True)
+
+    def bandsGroup(self):
+        return self.image().bandsGroup(self.bands)
+
+
 class ImgSpectral:
 #********************************* Default Config ************************************
     validExtensions = ['sentinel2', 'landsat8', 'landsat7', 'hyperion']
@@ -185,6 +582,23 @@ class ImgSpectral:
     resizeFactor = 8
     cache = True
     verbose = False
+    workers = 1
+    cacheMmap = None        # None carga el cache en memoria, 'r' o 'c' lo mapea con np.memmap
+    pyramid = True          # Derivar factores a partir de factores menores ya guardados en cache
+    pyramidLevels = [2, 4, 8, 16, 32]
+    blockPixels = 4000000   # Pixeles de origen leidos por bloque en iterBlocks
+    loadStrategy = 'mean'   # 'mean' promedia en NumPy, 'decoder' reduce en GDAL, 'auto' usa GDAL si hay overviews o JP2
+    dtype = np.float64      # Tipo de los arrays en memoria y en cache (ej. np.uint16 o np.float32)
+    computeDtype = np.float64   # Tipo usado para calcular los promedios
+    renderMode = 'float'    # 'float' devuelve float16 en [0, 1], 'lut' devuelve uint8 usando una tabla
+    catalog = True          # Indexar los archivos de bandas en un catalogo persistente
+    metrics = None          # ImgMetrics para registrar tiempos, bytes y aciertos de cache
+    memoryCache = None      # ImgMemoryCache compartido por todas las escenas, None guarda los grupos en cada instancia
+    asyncWorkers = 4        # Hilos compartidos por abandsGroup, aband, argb y aopen
+    prefetchWorkers = 1     # Hilos compartidos por las cargas anticipadas (prefetch)
+    batchConfig = ['catalog', 'workers', 'cacheMmap', 'pyramid', 'loadStrategy', 'dtype', 'computeDtype', 'verbose']
+    batchShared = {ImgCache : ['root', 'manifest', 'manifestFile', 'budget', 'lockFiles', 'touchInterval', 'journalEntries'],
+        ImgCatalog : ['fileName', 'persist']}   # Configuracion de otras clases copiada a los procesos de batch
 
     RGBDinamicRange = .93
     colorSpacePower = .5
@@ -192,13 +606,17 @@ class ImgSpectral:
     linearSpace = np.linspace(0, 1, 100)
     colorSpace = 2 - 2/(linearSpace**colorSpacePower + 1)
 
+    __executors__ = {}
+    __executorsLock__ = threading.Lock()
+
 #********************************* Constructor **************************************
 
-    def __init__(self, path, resizeFactor = None, cache = None, subset= None, subsetMode='latlon') :
+    def __init__(self, path, resizeFactor = None, cache = None, subset= None, subsetMode='latlon', parent = None) :
         path_split = path.split('.')
         self.path = path
         self.resizeFactor = resizeFactor if not resizeFactor is None else ImgSpectral.resizeFactor
         self.cache = cache if not (cache is None) else ImgSpectral.cache
+        self.workers = ImgSpectral.workers
         self.extension = path_split[-1]
         if not(self.extension in ImgSpectral.validExtensions) :
             raise ValueError('Invalid Path Extension')
@@ -208,36 +626,224 @@ class ImgSpectral:
         self.config = ImgSpectral.extensionsConfig[self.extension]
         self.__subset = subset
         self.__subsetMode = subsetMode
-        self.__selectBandsFiles__()
-        cacheFolderName = str(self.resizeFactor)
-        self.pathCahe = self.pathFolder/'.imgspectral/cache'/cacheFolderName
+        self.__parent = parent
+        if parent is None:
+            self.__selectBandsFiles__()
+            self.datasets = {}
+            self.__bandLocks = {}
+            self.__bandLocksLock = threading.Lock()
+        else:
+            self.bandsFiles = parent.bandsFiles
+            self.bandsIndex = parent.bandsIndex
+            self.datasets = parent.datasets
+            self.__bandLocks = parent.__bandLocks
+            self.__bandLocksLock = parent.__bandLocksLock
+        self.__pending__ = {}
+        self.__pendingLock = threading.RLock()
+        self.__groupBands__ = {}
+        self.pathCahe = self.__cachePath__(self.resizeFactor)
         self.__bandsGroups__ = {}
-        self.datasets = {}
+        self.__lazyBandsGroups__ = {}
 
 #**********************************  User Methods ***********************************
 
     def subset(self, subset, subsetMode='latlon'):
-        return ImgSpectral(self.path, self.resizeFactor, self.cache, subset, subsetMode)
+        return ImgSpectral(self.path, self.resizeFactor, self.cache, subset, subsetMode, self)
 
     def bandsGroup(self, bands):
         if len(bands) < 1:
             raise ValueError("Not can load zero bands")
         bands = [str(band) for band in bands]
         group = self.__groupName__(bands)
-        if not group in self.__bandsGroups__:
+        return self.__memoized__(group, lambda: self.__loadGroup__(group, bands))
+
+    def band(self, band):
+        return self.bandsGroup([band])
+
+    @staticmethod
+    async def aopen(path, resizeFactor = None, cache = None, subset= None, subsetMode='latlon'):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(ImgSpectral.__executor__('load'), 
+            lambda: ImgSpectral(path, resizeFactor, cache, subset, subsetMode))
+
+    async def abandsGroup(self, bands, prefetch = None):
+        if len(bands) < 1:
+            raise ValueError("Not can load zero bands")
+        bands = [str(band) for band in bands]
+        group = self.__groupName__(bands)
+        task = None
+        data = self.__peekGroup__(group)
+        if data is None:
+            task = self.__submit__(group, 'load', self.bandsGroup, bands)
+        if not prefetch is None:
+            self.prefetch(*prefetch)
+        if task is None:
+            return data
+        return await asyncio.shield(asyncio.wrap_future(task))
+
+    async def aband(self, band, prefetch = None):
+        return await self.abandsGroup([band], prefetch)
+
+    async def argb(self, bands = None, prefetch = None):
+        bands = [str(band) for band in (self.config["rgbBands"] if bands is None else bands)]
+        await self.abandsGroup(bands, prefetch)
+        task = self.__submit__(self.__groupName__(bands) + '.rgb', 'load', self.rgb, bands)
+        return await asyncio.shield(asyncio.wrap_future(task))
+
+    def prefetch(self, *groups):
+        for bands in groups:
+            bands = [str(band) for band in bands]
+            group = self.__groupName__(bands)
+            if self.__peekGroup__(group) is None:
+                self.__submit__(group, 'prefetch', self.bandsGroup, bands)
+
+    def close(self):
+        groups = list(self.__bandsGroups__.values()) + list(self.__lazyBandsGroups__.values())
+        if not self.memoryCache is None:
+            # Los grupos compartidos de esta escena pudieron reabrir sus archivos despues de cargarse
+            groups += [self.memoryCache.peek(self.__memoryKey__(group)) for group in list(self.__groupBands__.keys())]
+        for data in groups:
+            ImgSpectral.__closeGroup__(data)
+        # Los subsets comparten los datasets de la escena padre, solo ella los libera
+        if self.__parent is None:
+            self.datasets.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def lazyBandsGroup(self, bands):
+        if len(bands) < 1:
+            raise ValueError("Not can load zero bands")
+        bands = [str(band) for band in bands]
+        group = self.__groupName__(bands)
+        if not self.__peekGroup__(group) is None or (self.cache and (self.pathCahe/(group + '.npy')).exists()):
+            return self.bandsGroup(bands)
+        if not group in self.__lazyBandsGroups__:
             ds =  self.__openBandsGroup__(bands)
             if len(bands) == 1:
-                self.__bandsGroups__[group] = self.__loadBand__(group, ds[0])
+                self.__lazyBandsGroups__[group] = LazyImgBand.make(ds[0], self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, **self.__options__())
             else:
-                self.__bandsGroups__[group] = self.__loadBandsGroup__(group, ds)
-        return self.__bandsGroups__[group]
+                self.__lazyBandsGroups__[group] = LazyImgBand.makeGroup(ds, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, **self.__options__())
+        return self.__lazyBandsGroups__[group]
 
-    def band(self, band):
-        return self.bandsGroup([band])
+    def lazyBand(self, band):
+        return self.lazyBandsGroup([band])
+
+    def iterBlocks(self, bands, blockRows = None, prefetch = False):
+        bands = [str(band) for band in bands]
+        geometry = ImgBand.geometry(self.__openBandsGroup__(bands), self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, **self.__options__())
+        rows, cols = geometry.factorShape
+        if blockRows is None:
+            blockRows = max(1, int(ImgSpectral.blockPixels/(cols*self.resizeFactor**2*len(bands))))
+        starts = list(range(0, rows, int(blockRows)))
+        read = lambda row: geometry.__readWindow__((row, min(row + blockRows, rows)), (0, cols)).reshape(
+            (min(row + blockRows, rows) - row, cols, len(bands)))
+        if not prefetch:
+            for row in starts:
+                yield row, 0, geometry.__windowGeoTransform__(row, 0), read(row)
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            task = executor.submit(read, starts[0]) if starts else None
+            for i in range(len(starts)):
+                block = task.result()
+                if i + 1 < len(starts):
+                    task = executor.submit(read, starts[i + 1])
+                yield starts[i], 0, geometry.__windowGeoTransform__(starts[i], 0), block
+
+    def chips(self, bands, centers, sizes, subsetMode = 'latlon', stack = True):
+        bands = [str(band) for band in bands]
+        geometry = ImgBand.geometry(self.__openBandsGroup__(bands), self.resizeFactor, None, subsetMode, self.verbose, **self.__options__())
+        windows = ImgSpectral.__chipWindows__(geometry, centers, sizes, subsetMode)
+        chips = self.__iterChips__(geometry, windows, len(bands))
+        if not stack:
+            return chips
+        if len(windows) > 0 and np.any(windows[:, 2:] != windows[0, 2:]):
+            raise ValueError("Chips must have the same size to be stacked")
+        shape = (len(windows),) + (tuple(windows[0, 2:]) if len(windows) > 0 else (0, 0)) + (len(bands),)
+        out = np.empty(shape, dtype=self.dtype)
+        for i, gt, chip in chips:
+            out[i] = chip
+        return out
+
+    def index(self, expression, cache = None, blockRows = None):
+        cache = self.cache if cache is None else cache
+        program = ImgIndex(expression)
+        name = 'index' + hashlib.md5(program.expression.encode()).hexdigest()[:16]
+        group = self.__groupName__([name])
+        self.__groupBands__[group] = program.bands
+        return self.__memoized__(group, lambda: self.__loadIndex__(group, program, cache, blockRows))
+
+    @staticmethod
+    def batch(paths, bands, workers = None, callback = None, resizeFactor = None):
+        resizeFactor = ImgSpectral.resizeFactor if resizeFactor is None else resizeFactor
+        config = ImgSpectral.__batchConfig__()
+        handles = [ImgSceneHandle(path, bands, resizeFactor) for path in paths]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tasks = {executor.submit(ImgSpectral.__batchScene__, handle, config) : i for i, handle in enumerate(handles)}
+            for done, task in enumerate(as_completed(tasks)):
+                i = tasks[task]
+                try:
+                    handles[i] = task.result()
+                except Exception as error:
+                    handles[i].error = error
+                if ImgSpectral.verbose:
+                    print('Batch %d/%d %s %s' % (done + 1, len(handles), handles[i].path, 
+                        'error' if not handles[i].error is None else 'loaded'))
+                if not callback is None:
+                    callback(handles[i], done + 1, len(handles))
+        return handles
+
+    def buildOverviews(self, bands, levels = None):
+        levels = ImgSpectral.pyramidLevels if levels is None else [int(l) for l in levels]
+        for band, dataset in zip(bands, self.__openBandsGroup__([str(band) for band in bands])):
+            if dataset.GetDriver().ShortName.startswith('JP2'):
+                continue
+            if dataset.GetRasterBand(1).GetOverviewCount() > 0:
+                continue
+            self.__print__('Building %s band %s overviews...' % (self.pathFolder.name, band))
+            dataset.BuildOverviews('AVERAGE', levels)
+
+    def buildPyramid(self, bands, levels = None):
+        if not self.__subset is None:
+            raise ValueError("Pyramid cache only supports full scenes")
+        levels = sorted(set(ImgSpectral.pyramidLevels if levels is None else [int(l) for l in levels]))
+        if any(level%levels[0] != 0 for level in levels):
+            raise ValueError("Pyramid levels must be multiples of the finest level")
+        bands = [str(band) for band in bands]
+        group = self.__groupName__(bands)
+        ds =  self.__openBandsGroup__(bands)
+        self.__print__('Loading %s %s pyramid from Dataset...' % (self.pathFolder.name, group))
+        # Los niveles se reducen desde promedios sin redondear y se redondean una sola vez al guardar
+        options = dict(self.__options__(), storeDtype=self.computeDtype)
+        if len(bands) == 1:
+            data = ImgBand.make(ds[0], levels[0], None, self.__subsetMode, self.verbose, **options)
+        else:
+            data = ImgBandsGroup.make(ds, levels[0], None, self.__subsetMode, self.verbose, workers=self.workers, **options)
+        data = np.asarray(data)
+        self.__saveCache__(group, ImgBand.__store__(data, self.dtype), levels[0])
+        built = {levels[0] : data}
+        for level in levels[1:]:
+            finer = max(f for f in built if level%f == 0)
+            built[level] = self.__pyramidReduce__(built[finer], int(level/finer), self.computeDtype)
+            self.__saveCache__(group, ImgBand.__store__(built[level], self.dtype), level)
 
     def rgb(self, bands = None):
         bands = self.config["rgbBands"] if bands is None else bands
-        return ImgSpectral.color(self.bandsGroup(bands))
+        group = self.bandsGroup(bands)
+        if not self.cache:
+            return ImgSpectral.color(group)
+        name = self.__groupName__([str(band) for band in bands])
+        statsPath, source = self.pathCahe/(name + '.stats.json'), self.pathCahe/(name + '.npy')
+        stats = ImgStats.load(statsPath, source)
+        if stats is None:
+            with ImgMetrics.timer(self.metrics, 'stats'):
+                stats = ImgStats.range(group)
+            ImgStats.save(statsPath, stats, source)
+        return ImgSpectral.color(group, stats)
     
     # def pixelLatLon(self, x, y):
     #     gt = self.geoTransform
@@ -246,11 +852,19 @@ class ImgSpectral:
     #     return (lat, lon)        
     
     @staticmethod
-    def color(reflectance):
+    def color(reflectance, stats = None):
+        with ImgMetrics.timer(ImgSpectral.metrics, 'render'):
+            return ImgSpectral.__color__(reflectance, stats)
+
+    @staticmethod
+    def __color__(reflectance, stats = None):
         if ImgSpectral.verbose:
             print("Processing Color...")
+        stats = ImgStats.range(reflectance) if stats is None else stats
+        if ImgSpectral.renderMode == 'lut':
+            return ImgSpectral.__colorLut__(reflectance, stats)
         _img = reflectance.astype(np.float16)
-        ImgSpectral.__normalice__(_img)
+        ImgSpectral.__normalice__(_img, stats)
         np.power(_img, np.array(ImgSpectral.colorSpacePower, dtype=np.float16),out=_img)
         np.add(_img, np.array(1, dtype=np.float16), out=_img)
         np.power(_img, np.array(-1, dtype=np.float16), out=_img)
@@ -258,6 +872,14 @@ class ImgSpectral:
         np.subtract(np.array(2, dtype=np.float16), _img, out=_img)
         return _img
 
+    @staticmethod
+    def __colorLut__(reflectance, stats):
+        index, values = ImgStats.quantize(reflectance, stats)
+        curve = np.clip((values - stats['min'])/(stats['max'] - stats['min']), 0, 1)
+        curve = 2 - 2/(curve**ImgSpectral.colorSpacePower + 1)
+        lut = np.rint(curve*255).astype(np.uint8)
+        return lut[index]
+
     @staticmethod
     def composite(*rgb):
         if len(rgb) == 1 and len(rgb[0].shape) == 3 and rgb[0].shape[2] == 3:
@@ -268,10 +890,281 @@ class ImgSpectral:
 
 #******************************** Intern Methods ************************************
 
+    @staticmethod
+    def __batchConfig__():
+        shared = [(ImgSpectral, ImgSpectral.batchConfig)] + list(ImgSpectral.batchShared.items())
+        return {(cls, name) : getattr(cls, name) for cls, names in shared for name in names}
+
+    @staticmethod
+    def __batchScene__(handle, config):
+        for (cls, name), value in config.items():
+            setattr(cls, name, value)
+        img = ImgSpectral(handle.path, handle.resizeFactor, True)
+        data = img.bandsGroup(handle.bands)
+        handle.cachePath = str(img.pathCahe/(img.__groupName__(handle.bands) + '.npy'))
+        handle.shape = data.shape
+        handle.dtype = data.dtype
+        return handle
+
+    @staticmethod
+    def __chipWindows__(geometry, centers, sizes, subsetMode):
+        centers = np.asarray(centers, dtype=np.float64).reshape((-1, 2))
+        sizes = np.broadcast_to(np.asarray(sizes, dtype=np.float64), centers.shape)
+        gt, f = geometry.geoTransform, geometry.resizeFactor
+        if subsetMode == 'latlon':
+            points = np.array(geometry.transToXY.TransformPoints([(c[1], c[0]) for c in centers]), dtype=np.float64).reshape((-1, 3))
+            x, y = (points[:,0] - gt[0])/gt[1], (points[:,1] - gt[3])/gt[5]
+            width, height = sizes[:,0]/abs(gt[1]), sizes[:,1]/abs(gt[5])
+        elif subsetMode == 'pixel':
+            x, y = centers[:,0], centers[:,1]
+            width, height = sizes[:,0], sizes[:,1]
+        else :
+            raise ValueError("Invalid subset Mode")
+        rows, cols = np.maximum(1, np.round(height/f)), np.maximum(1, np.round(width/f))
+        row, col = np.round(y/f - rows/2), np.round(x/f - cols/2)
+        return np.stack((row, col, rows, cols), axis=1).astype(int)
+
+    def __iterChips__(self, geometry, windows, nBands):
+        f = geometry.resizeFactor
+        shape = geometry.factorShape
+        blockRows = max(1, int(ImgSpectral.blockPixels/(shape[1]*f**2*nBands)))
+        fill = np.nan if np.issubdtype(self.dtype, np.floating) else 0
+        block = []
+        for i in np.argsort(windows[:,0], kind='stable'):
+            row, col, rows, cols = windows[i]
+            if len(block) > 0 and (row >= end or max(end, row + rows) - start > blockRows):
+                yield from self.__readChips__(geometry, windows, block, start, end, nBands, fill)
+                block = []
+            if len(block) == 0:
+                start, end = row, row + rows
+            block.append(i)
+            end = max(end, row + rows)
+        if len(block) > 0:
+            yield from self.__readChips__(geometry, windows, block, start, end, nBands, fill)
+
+    def __readChips__(self, geometry, windows, block, start, end, nBands, fill):
+        shape = geometry.factorShape
+        rowRange = (max(0, start), min(shape[0], end))
+        segment = []
+        for i in sorted(block, key=lambda i: windows[i, 1]):
+            col = windows[i, 1]
+            if len(segment) > 0 and col > segmentEnd:
+                yield from self.__fillChips__(geometry, windows, segment, rowRange, segmentStart, segmentEnd, nBands, fill)
+                segment = []
+            if len(segment) == 0:
+                segmentStart, segmentEnd = col, col + windows[i, 3]
+            segment.append(i)
+            segmentEnd = max(segmentEnd, col + windows[i, 3])
+        if len(segment) > 0:
+            yield from self.__fillChips__(geometry, windows, segment, rowRange, segmentStart, segmentEnd, nBands, fill)
+
+    def __fillChips__(self, geometry, windows, segment, rowRange, segmentStart, segmentEnd, nBands, fill):
+        colRange = (max(0, segmentStart), min(geometry.factorShape[1], segmentEnd))
+        data = None
+        if rowRange[1] > rowRange[0] and colRange[1] > colRange[0]:
+            data = geometry.__readWindow__(rowRange, colRange).reshape(
+                (rowRange[1] - rowRange[0], colRange[1] - colRange[0], nBands))
+        for i in segment:
+            row, col, rows, cols = [int(v) for v in windows[i]]
+            chip = np.full((rows, cols, nBands), fill, dtype=self.dtype)
+            r0, r1 = max(row, rowRange[0]), min(row + rows, rowRange[1])
+            c0, c1 = max(col, colRange[0]), min(col + cols, colRange[1])
+            if not data is None and r1 > r0 and c1 > c0:
+                chip[r0 - row : r1 - row, c0 - col : c1 - col] = data[r0 - rowRange[0] : r1 - rowRange[0], c0 - colRange[0] : c1 - colRange[0]]
+            yield int(i), geometry.__windowGeoTransform__(row, col), chip
+
+    @staticmethod
+    def __executor__(kind):
+        with ImgSpectral.__executorsLock__:
+            if not kind in ImgSpectral.__executors__:
+                workers = ImgSpectral.asyncWorkers if kind == 'load' else ImgSpectral.prefetchWorkers
+                ImgSpectral.__executors__[kind] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='imgspectral-' + kind)
+            return ImgSpectral.__executors__[kind]
+
+    def __submit__(self, key, kind, function, bands):
+        with self.__pendingLock:
+            pending = self.__pending__.get(key)
+            if not pending is None:
+                task, pendingKind = pending
+                # Una carga anticipada aun en cola se adelanta al ejecutor principal
+                if not (kind == 'load' and pendingKind == 'prefetch' and task.cancel()):
+                    return task
+            task = ImgSpectral.__executor__(kind).submit(self.__locked__, function, bands)
+            self.__pending__[key] = (task, kind)
+        task.add_done_callback(lambda done: self.__done__(key, done))
+        return task
+
+    def __done__(self, key, task):
+        with self.__pendingLock:
+            if key in self.__pending__ and self.__pending__[key][0] is task:
+                del self.__pending__[key]
+
+    def __locked__(self, function, bands):
+        # Solo se serializan las cargas que comparten bandas (y por lo tanto datasets de GDAL);
+        # grupos distintos y subsets de otras bandas cargan en paralelo
+        with ExitStack() as stack:
+            for band in sorted(set(bands)):
+                stack.enter_context(self.__bandLock__(band))
+            return function(bands)
+
+    def __bandLock__(self, band):
+        with self.__bandLocksLock:
+            if not band in self.__bandLocks:
+                self.__bandLocks[band] = threading.Lock()
+            return self.__bandLocks[band]
+
+    def __options__(self):
+        return {'loadStrategy' : self.loadStrategy, 'storeDtype' : self.dtype, 'computeDtype' : self.computeDtype,
+            'metrics' : self.metrics}
+
     def __groupName__(self, bands):
         bands_name = '_'.join(bands)
         subset_name = "None" if self.__subset is None else '_'.join([str(i) for i in self.__subset])
-        return bands_name + "x" + subset_name + "x" + self.__subsetMode
+        group = bands_name + "x" + subset_name + "x" + self.__subsetMode
+        self.__groupBands__.setdefault(group, list(bands))
+        return group
+
+    def __sources__(self, group):
+        bands = self.__groupBands__.get(group)
+        if bands is None:
+            return None
+        paths = [self.__findBandPathFile__(band) for band in bands]
+        return None if None in paths else [self.pathFolder/path for path in paths]
+
+    def __memoryKey__(self, group):
+        return (str(self.pathFolder.resolve()), self.extension, self.resizeFactor, group, np.dtype(self.dtype).str)
+
+    def __memoized__(self, group, load):
+        if self.memoryCache is None:
+            if not group in self.__bandsGroups__:
+                self.__bandsGroups__[group] = load()
+            return self.__bandsGroups__[group]
+        # Una sola carga por grupo entre escenas e hilos; el grupo compartido no retiene
+        # los archivos de GDAL, que se vuelven a abrir solo si se necesitan
+        return self.memoryCache.fetch(self.__memoryKey__(group), lambda: ImgSpectral.__closeGroup__(load()))
+
+    @staticmethod
+    def __closeGroup__(data):
+        data = data.imgBand if isinstance(data, LazyImgBand) else data
+        if isinstance(data, ImgBand):
+            data.close()
+        return data
+
+    def __loadGroup__(self, group, bands):
+        data = self.__loadFromMeta__(group, bands) if self.cache else None
+        if data is None:
+            with self.__cacheLock__(group, self.cache):
+                data = self.__loadFromMeta__(group, bands) if self.cache else None
+                if data is None:
+                    data = self.__loadFromSources__(group, bands)
+        return data
+
+    def __loadIndex__(self, group, program, cache, blockRows):
+        options = self.__options__()
+        options['storeDtype'] = ImgIndex.dtype
+        data = self.__loadFromMeta__(group, program.bands, **options) if cache else None
+        if data is None:
+            with self.__cacheLock__(group, cache):
+                data = self.__loadFromMeta__(group, program.bands, **options) if cache else None
+                if data is None:
+                    data = self.__computeIndex__(group, program, cache, blockRows, options)
+        return data
+
+    def __getGroup__(self, group):
+        if self.memoryCache is None:
+            return self.__bandsGroups__.get(group)
+        return self.memoryCache.get(self.__memoryKey__(group))
+
+    def __peekGroup__(self, group):
+        if self.memoryCache is None:
+            return self.__bandsGroups__.get(group)
+        return self.memoryCache.peek(self.__memoryKey__(group))
+
+    def __loadFromParent__(self, bands, datasets):
+        parent = self.__parent
+        if parent is None or parent.resizeFactor != self.resizeFactor:
+            return None
+        group = parent.__groupName__(bands)
+        data = parent.__getGroup__(group)
+        if data is None and parent.cache:
+            data = parent.__readCache__(group)
+        if data is None:
+            return None
+        f = self.resizeFactor
+        child = ImgBand.geometry(datasets, f, self.__subset, self.__subsetMode, self.verbose, **self.__options__())
+        source = ImgBand.geometry(datasets, f, parent.__subset, parent.__subsetMode, self.verbose, **self.__options__())
+        x, y = child.realSubset[0] - source.realSubset[0], child.realSubset[1] - source.realSubset[1]
+        if x%f != 0 or y%f != 0 or x < 0 or y < 0:
+            return None
+        row, col = int(y/f), int(x/f)
+        if row + child.factorShape[0] > data.shape[0] or col + child.factorShape[1] > data.shape[1]:
+            return None
+        self.__print__('Slicing %s %s data from parent' % (self.pathFolder.name, self.__groupName__(bands)))
+        cache = np.ascontiguousarray(data[row : row + child.factorShape[0], col : col + child.factorShape[1]])
+        if len(datasets) == 1:
+            return ImgBand.make(datasets[0], f, self.__subset, self.__subsetMode, self.verbose, cache, **self.__options__())
+        return ImgBandsGroup.make(datasets, f, self.__subset, self.__subsetMode, self.verbose, cache, self.workers, **self.__options__())
+
+    def __cacheLock__(self, group, cache = True):
+        return ImgCache.lock(self.pathCahe/(group + '.npy')) if cache else nullcontext()
+
+    def __loadFromSources__(self, group, bands):
+        ds =  self.__openBandsGroup__(bands)
+        data = self.__loadFromParent__(bands, ds)
+        if data is None and len(bands) == 1:
+            data = self.__loadBand__(group, ds[0])
+        elif data is None:
+            data = self.__loadBandsGroup__(group, ds)
+        if self.cache:
+            self.__saveMeta__(group, data)
+        return data
+
+    def __computeIndex__(self, group, program, cache, blockRows, options):
+        datasets = self.__openBandsGroup__(program.bands)
+        data = self.__readCache__(group, ImgIndex.dtype, False) if cache else None
+        if data is None:
+            self.__print__('Computing %s index %s...' % (self.pathFolder.name, program.expression))
+            for row, col, gt, block in self.iterBlocks(program.bands, blockRows):
+                if data is None:
+                    geometry = ImgBand.geometry(datasets, self.resizeFactor, self.__subset, self.__subsetMode)
+                    data = np.empty(geometry.factorShape, dtype=ImgIndex.dtype)
+                    ImgMetrics.allocated(self.metrics, data)
+                    buffers = program.buffers(block.shape[0:2])
+                program.evaluate(block, data[row : row + block.shape[0]], buffers)
+            if cache:
+                self.__saveCache__(group, data)
+        reference = datasets[ImgBandsGroup.__reference__(datasets)]
+        index = ImgBand.make(reference, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, data, **options)
+        index.reference = datasets.index(reference)
+        index.paths = [str(self.pathFolder/self.__findBandPathFile__(band)) for band in program.bands]
+        if cache:
+            self.__saveMeta__(group, index)
+        return index
+
+    def __loadFromMeta__(self, group, bands, **options):
+        options = self.__options__() if len(options) == 0 else options
+        pathMeta = self.pathCahe/(group + '.meta.json')
+        if not pathMeta.exists():
+            return None
+        try:
+            with open(pathMeta) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        paths = [self.__findBandPathFile__(band) for band in bands]
+        if None in paths:
+            return None
+        # Las huellas de origen se verifican en el manifiesto de ImgCache, que descarta el .npy y sus sidecars
+        cache = self.__readCache__(group, options['storeDtype'], False)
+        if cache is None or list(cache.shape) != meta['shape']:
+            return None
+        return ImgBand.fromCache(cache, meta, [self.pathFolder/path for path in paths], self.verbose, self.workers, **options)
+
+    def __saveMeta__(self, group, data):
+        if not isinstance(data, ImgBand) or not (self.pathCahe/(group + '.npy')).exists():
+            return
+        meta = data.describe()
+        ImgCache.write(self.pathCahe/(group + '.meta.json'), lambda f: f.write(json.dumps(meta).encode()))
 
     def __loadBand__(self, cachePathFile, dataset):
         band = None
@@ -279,7 +1172,7 @@ class ImgSpectral:
             band = self.__loadBandFromCache__(cachePathFile, dataset)
         if band is None:
             self.__print__('Loading %s %s image from Dataset...' % (self.pathFolder.name, cachePathFile))
-            band = ImgBand.make(dataset, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose)
+            band = ImgBand.make(dataset, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, **self.__options__())
             if self.cache :
                 self.__saveCache__(cachePathFile, band)
         return band
@@ -290,7 +1183,7 @@ class ImgSpectral:
             bandsGroup = self.__loadGroupFromCache__(cachePathFile, datasetGroup)
         if bandsGroup is None:
             self.__print__('Loading %s %s image from Dataset...' % (self.pathFolder.name, cachePathFile))
-            bandsGroup = ImgBandsGroup.make(datasetGroup, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose)
+            bandsGroup = ImgBandsGroup.make(datasetGroup, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, workers=self.workers, **self.__options__())
             if self.cache :
                 self.__saveCache__(cachePathFile, bandsGroup)
         return bandsGroup
@@ -300,10 +1193,9 @@ class ImgSpectral:
             print(message, end=end)
 
     @staticmethod
-    def __normalice__(_img):
-        _nan = max(-100, np.min(_img))
-        _min = np.min(_img[_img > _nan])
-        _max = np.max(_img)
+    def __normalice__(_img, stats = None):
+        stats = ImgStats.range(_img) if stats is None else stats
+        _min, _max = stats['min'], stats['max']
         np.subtract(_img, _min, out=_img)
         np.multiply(_img, np.array(1/(_max - _min), dtype=np.float16) , out=_img)
         np.clip(_img, 0, 1, out=_img)
@@ -322,12 +1214,31 @@ class ImgSpectral:
 
     def __selectBandsFiles__(self):
         self.bandsFiles = []
+        self.bandsIndex = None
+        if self.catalog:
+            catalog = ImgCatalog.get(self.pathFolder, self.config['bandsExtensions'])
+            key = 'imgspectral' + self.config['nameSeparator'] + ','.join(self.config['bandsPrefixes'])
+            self.bandsIndex = catalog.index(key, self.__indexBandsFiles__)
+            return
         for ext in self.config['bandsExtensions']:
             paths = list(self.pathFolder.glob('**/*.' + ext))
             for path in paths:
                 self.bandsFiles.append(path.name.split('.'))    
         
+    def __indexBandsFiles__(self, catalog):
+        index = {}
+        for ext in self.config['bandsExtensions']:
+            for path in catalog.files[ext]:
+                name = Path(path).name.split('.')[0]
+                for part in name.split(self.config['nameSeparator']):
+                    for prefix in self.config['bandsPrefixes']:
+                        if part.startswith(prefix) and len(part) > len(prefix):
+                            index.setdefault(part[len(prefix):], path)
+        return index
+
     def __findBandPathFile__(self, bandName):
+        if not self.bandsIndex is None:
+            return self.bandsIndex.get(bandName)
         for name, ext in self.bandsFiles:
             for part in name.split(self.config['nameSeparator']):
                 for prefix in self.config['bandsPrefixes']:
@@ -335,21 +1246,69 @@ class ImgSpectral:
                         return name + '.' + ext
         return None
 
+    def __cachePath__(self, factor):
+        return ImgCache.folder(self.pathFolder, '.imgspectral/cache')/str(factor)
+
+    def __readCache__(self, filePath, dtype = None, pyramid = True):
+        dtype = self.dtype if dtype is None else dtype
+        with ImgMetrics.timer(self.metrics, 'cache.read'):
+            cache = ImgCache.load(self.pathCahe/(filePath + '.npy'), self.cacheMmap, self.__sources__(filePath))
+        if not cache is None :
+            self.__print__('Loading %s %s data from Cache' % (self.pathFolder.name, filePath))
+            ImgMetrics.count(self.metrics, 'cache.hit')
+            ImgMetrics.count(self.metrics, 'cache.bytesRead', cache.nbytes)
+            return cache if cache.dtype == dtype else ImgBand.__store__(cache, dtype)
+        if not (self.pyramid and pyramid) or not self.__subset is None:
+            ImgMetrics.count(self.metrics, 'cache.miss')
+            return None
+        for factor in range(self.resizeFactor - 1, 0, -1):
+            pathFile = self.__cachePath__(factor)/(filePath + '.npy')
+            if self.resizeFactor%factor != 0 or not pathFile.exists():
+                continue
+            finer = ImgCache.load(pathFile, 'r', self.__sources__(filePath))
+            if finer is None:
+                continue
+            self.__print__('Reducing %s %s data from Cache factor %d' % (self.pathFolder.name, filePath, factor))
+            with ImgMetrics.timer(self.metrics, 'cache.pyramid'):
+                cache = self.__pyramidReduce__(finer, int(self.resizeFactor/factor))
+            ImgMetrics.count(self.metrics, 'cache.pyramidHit')
+            ImgMetrics.count(self.metrics, 'cache.bytesRead', finer.nbytes)
+            self.__saveCache__(filePath, cache)
+            return cache
+        ImgMetrics.count(self.metrics, 'cache.miss')
+        return None
+
+    def __pyramidReduce__(self, data, k, dtype = None):
+        rows, cols = int(data.shape[0]/k), int(data.shape[1]/k)
+        data = np.asarray(data[:rows*k, :cols*k]).reshape((rows, k, cols, k) + data.shape[2:])
+        return ImgBand.__store__(data.mean(axis=(1, 3), dtype=self.computeDtype), self.dtype if dtype is None else dtype)
+
     def __loadBandFromCache__(self, filePath, dataset) :
-        if not (self.pathCahe/(filePath + '.npy')).exists() :
+        cache = self.__readCache__(filePath)
+        if cache is None :
             return None
-        self.__print__('Loading %s %s data from Cache' % (self.pathFolder.name, filePath))
-        cache = np.load(self.pathCahe/(filePath + '.npy'))
-        return ImgBand.make(dataset, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, cache)
+        return ImgBand.make(dataset, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, cache, **self.__options__())
 
     def __loadGroupFromCache__(self, filePath, datasets) :
-        if not (self.pathCahe/(filePath + '.npy')).exists() :
+        cache = self.__readCache__(filePath)
+        if cache is None :
             return None
-        self.__print__('Loading %s %s data from Cache' % (self.pathFolder.name, filePath))
-        cache = np.load(self.pathCahe/(filePath + '.npy'))
-        return ImgBandsGroup.make(datasets, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, cache)
+        return ImgBandsGroup.make(datasets, self.resizeFactor, self.__subset, self.__subsetMode, self.verbose, cache, self.workers, **self.__options__())
         
-    def __saveCache__(self, filePath, data) :
-        if not self.pathCahe.exists() : 
-            self.pathCahe.mkdir(parents = True, exist_ok=True)
-        np.save(self.pathCahe/(filePath + '.npy'), data)
+    def convertCache(self, dtype = None):
+        dtype = self.dtype if dtype is None else dtype
+        for pathFile in ImgCache.folder(self.pathFolder, '.imgspectral/cache').glob('*/*.npy'):
+            data = np.load(pathFile, mmap_mode='r')
+            if data.dtype == dtype:
+                continue
+            self.__print__('Converting %s to %s' % (str(pathFile), np.dtype(dtype).name))
+            converted = ImgBand.__store__(np.asarray(data), dtype)
+            del data
+            with ImgCache.lock(pathFile):
+                ImgCache.save(pathFile, converted)
+
+    def __saveCache__(self, filePath, data, factor = None) :
+        pathCache = self.pathCahe if factor is None else self.__cachePath__(factor)
+        with ImgMetrics.timer(self.metrics, 'cache.write'):
+            ImgCache.save(pathCache/(filePath + '.npy'), data, self.__sources__(filePath))
+        ImgMetrics.count(self.metrics, 'cache.bytesWritten', data.nbytes)
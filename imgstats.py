@@ -0,0 +1,156 @@
+import os
+import json
+import numpy as np
+from pathlib import Path
+from imgcache import ImgCache
+
+class ImgStats:
+
+#********************************* Default Config ************************************
+
+    bins = 4096
+    chunkPixels = 4000000
+    nanFloor = -100
+
+#**********************************  User Methods ***********************************
+
+    @staticmethod
+    def range(img, nanFloor = None):
+        nanFloor = ImgStats.nanFloor if nanFloor is None else nanFloor
+        _min = _max = _second = _valid = None
+        minCount = validCount = size = 0
+        for chunk in ImgStats.__chunks__(img):
+            cmin, cmax = np.min(chunk), np.max(chunk)
+            above = chunk[chunk > cmin]
+            csecond = np.min(above) if above.size > 0 else None
+            valid = chunk[chunk > nanFloor]
+            cvalid = np.min(valid) if valid.size > 0 else None
+            if _min is None or cmin < _min:
+                if not _min is None:
+                    csecond = _min if csecond is None else min(csecond, _min)
+                _min, minCount = cmin, chunk.size - above.size
+            elif cmin > _min:
+                csecond = cmin if csecond is None else min(csecond, cmin)
+            else:
+                minCount += chunk.size - above.size
+            _second = ImgStats.__minOf__(_second, csecond)
+            _valid = ImgStats.__minOf__(_valid, cvalid)
+            _max = cmax if _max is None else max(_max, cmax)
+            validCount += valid.size
+            size += chunk.size
+        _nan = max(nanFloor, _min)
+        low = _second if _nan == _min else _valid
+        count = size - minCount if _nan == _min else validCount
+        return {'nan' : float(_nan), 'min' : float(_min if low is None else low), 'max' : float(_max), 'count' : int(count)}
+
+    @staticmethod
+    def histogram(img, low = 0, high = 1, bins = None):
+        bins = ImgStats.bins if bins is None else bins
+        channels = 1 if img.ndim < 3 else img.shape[2]
+        hist = np.zeros((channels, bins), dtype=np.int64)
+        _max = None
+        for chunk in ImgStats.__chunks__(img):
+            chunk = chunk.reshape((-1, channels))
+            for c in range(channels):
+                values = chunk[:,c][chunk[:,c] > low]
+                hist[c] += np.histogram(values, bins, range=(low, high))[0]
+            cmax = np.max(chunk)
+            _max = cmax if _max is None else max(_max, cmax)
+        edges = np.linspace(low, high, bins + 1)
+        return hist, edges, float(_max)
+
+    @staticmethod
+    def quantile(hist, edges, q):
+        cumulative = np.cumsum(hist)
+        if cumulative[-1] == 0:
+            return float(edges[0])
+        position = q*cumulative[-1]
+        i = min(int(np.searchsorted(cumulative, position, side='left')), len(hist) - 1)
+        previous = 0 if i == 0 else cumulative[i - 1]
+        fraction = 0 if hist[i] == 0 else (position - previous)/hist[i]
+        return float(edges[i] + fraction*(edges[i + 1] - edges[i]))
+
+    @staticmethod
+    def clipPoints(img, dinamicRange, low = 0, high = 1, bins = None):
+        hist, edges, _max = ImgStats.histogram(img, low, high, bins)
+        mins = [ImgStats.quantile(h, edges, 1 - dinamicRange) for h in hist]
+        maxs = [ImgStats.quantile(h, edges, dinamicRange) for h in hist]
+        return {'low' : min(mins), 'high' : max(maxs), 'top' : _max}
+
+    @staticmethod
+    def quantize(img, stats, levels = 65536):
+        if np.issubdtype(img.dtype, np.integer) and np.iinfo(img.dtype).min >= 0 and np.iinfo(img.dtype).max < levels:
+            return img, np.arange(np.iinfo(img.dtype).max + 1, dtype=np.float64)
+        _min, _max = stats['min'], stats['max']
+        index = np.empty(img.shape, dtype=np.uint16 if levels <= 65536 else np.uint32)
+        scale = (levels - 1)/(_max - _min)
+        row = 0
+        for chunk in ImgStats.__chunks__(img):
+            chunk = np.subtract(chunk, _min, dtype=np.float32)
+            np.multiply(chunk, scale, out=chunk)
+            np.clip(chunk, 0, levels - 1, out=chunk)
+            np.rint(chunk, out=chunk)
+            index[row : row + chunk.shape[0]] = chunk
+            row += chunk.shape[0]
+        return index, _min + np.arange(levels)/scale
+
+    @staticmethod
+    def counts(index, length):
+        channels = 1 if index.ndim < 3 else index.shape[2]
+        counts = np.zeros((channels, length), dtype=np.int64)
+        for chunk in ImgStats.__chunks__(index):
+            chunk = chunk.reshape((-1, channels))
+            for c in range(channels):
+                counts[c] += np.bincount(chunk[:,c], minlength=length)[:length]
+        return counts
+
+    @staticmethod
+    def load(path, source = None):
+        path = Path(path)
+        if not path.exists():
+            return None
+        try:
+            with open(path) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Las estadisticas solo valen para la entrada de cache de la que se calcularon
+        if not isinstance(stats, dict) or stats.pop('source', None) != ImgStats.fingerprint(source):
+            return None
+        return stats
+
+    @staticmethod
+    def save(path, stats, source = None):
+        stats = dict(stats, source=ImgStats.fingerprint(source))
+        try:
+            ImgCache.write(path, lambda f: f.write(json.dumps(stats).encode()))
+        except OSError:
+            pass
+
+    @staticmethod
+    def fingerprint(source):
+        if source is None:
+            return None
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        return {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}
+
+#******************************** Intern Methods ************************************
+
+    @staticmethod
+    def __chunks__(img):
+        rows = ImgStats.__chunkRows__(img)
+        for row in range(0, img.shape[0], rows):
+            yield np.asarray(img[row : row + rows])
+
+    @staticmethod
+    def __chunkRows__(img):
+        return max(1, int(ImgStats.chunkPixels/max(1, img.size/max(1, img.shape[0]))))
+
+    @staticmethod
+    def __minOf__(a, b):
+        if a is None:
+            return b
+        return a if b is None else min(a, b)
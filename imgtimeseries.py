@@ -0,0 +1,220 @@
+import json
+import warnings
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from imgspectral import ImgSpectral, ImgBand, ImgBandsGroup
+from imgmetrics import ImgMetrics
+from imgcache import ImgCache
+
+class ImgTimeSeries:
+
+#********************************* Default Config ************************************
+
+    workers = 4             # Escenas cargadas en paralelo al construir el cubo
+    dtype = np.float32      # Tipo del cubo en disco
+    cache = False           # Guardar tambien el recorte de cada escena en su cache de ImgSpectral
+    verbose = False
+    metrics = None          # ImgMetrics para registrar tiempos de carga y de estadisticas
+
+    statistics = {
+        'mean' : np.nanmean,
+        'std' : np.nanstd,
+        'min' : np.nanmin,
+        'max' : np.nanmax,
+        'median' : np.nanmedian,
+        'count' : lambda a, axis: np.sum(~np.isnan(a), axis=axis),
+    }
+
+#********************************* Constructor **************************************
+
+    def __init__(self, path, cube, meta):
+        self.path = Path(path)
+        self.cube = cube
+        self.paths = meta['paths']
+        self.dates = meta['dates']
+        self.bands = meta['bands']
+        self.geoTransform = tuple(meta['geoTransform'])
+        self.projection = meta['projection']
+        self.resizeFactor = meta['resizeFactor']
+        self.loaded = meta['loaded']
+        self.errors = meta.get('errors', [None]*len(self.paths))
+
+#**********************************  User Methods ***********************************
+
+    @staticmethod
+    def build(path, paths, bands, subset = None, subsetMode = 'latlon', resizeFactor = None, dates = None, workers = None):
+        if len(paths) < 1:
+            raise ValueError("Not can build a time series without scenes")
+        if not dates is None and len(dates) != len(paths):
+            raise ValueError("Dates and paths must have the same length")
+        path = Path(path)
+        bands = [str(band) for band in bands]
+        resizeFactor = ImgSpectral.resizeFactor if resizeFactor is None else resizeFactor
+        workers = ImgTimeSeries.workers if workers is None else workers
+        reference = ImgSpectral(paths[0], resizeFactor, False)
+        datasets = reference.__openBandsGroup__(bands)
+        grid = ImgBand.geometry(datasets, resizeFactor, subset, subsetMode, ImgTimeSeries.verbose, **reference.__options__())
+        # Enteros de Python: numpy 2 escribe np.int64(...) en la cabecera del .npy y no se puede volver a abrir
+        rows, cols = int(grid.factorShape[0]), int(grid.factorShape[1])
+        path.parent.mkdir(parents = True, exist_ok=True)
+        cube = np.lib.format.open_memmap(path, mode='w+', dtype=ImgTimeSeries.dtype, shape=(len(paths), rows, cols, len(bands)))
+        cube[:] = ImgTimeSeries.__fill__(cube.dtype)
+        meta = {'paths' : [str(p) for p in paths], 'dates' : None if dates is None else [str(d) for d in dates],
+            'bands' : bands, 'geoTransform' : [float(v) for v in grid.__windowGeoTransform__(0, 0)],
+            'projection' : grid.projection, 'resizeFactor' : int(resizeFactor), 'shape' : list(cube.shape),
+            'dtype' : cube.dtype.str, 'loaded' : [False]*len(paths), 'errors' : [None]*len(paths)}
+        reference.close()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            tasks = [executor.submit(ImgTimeSeries.__loadScene__, cube, t, paths[t], bands, meta) for t in range(len(paths))]
+            for t, task in enumerate(tasks):
+                # Una escena con error queda sin datos en el cubo y no impide guardar el resto
+                try:
+                    meta['loaded'][t] = task.result()
+                    status = 'loaded' if meta['loaded'][t] else 'outside grid'
+                except Exception as error:
+                    cube[t] = ImgTimeSeries.__fill__(cube.dtype)
+                    meta['errors'][t] = '%s: %s' % (type(error).__name__, error)
+                    status = 'error ' + meta['errors'][t]
+                    warnings.warn('Time series scene %s not loaded: %s' % (paths[t], meta['errors'][t]), RuntimeWarning)
+                ImgTimeSeries.__print__('Time series %d/%d %s %s' % (t + 1, len(paths), paths[t], status))
+        cube.flush()
+        ImgCache.write(ImgTimeSeries.__metaPath__(path), lambda f: f.write(json.dumps(meta).encode()))
+        del cube
+        return ImgTimeSeries.open(path)
+
+    @staticmethod
+    def open(path, mmapMode = 'r'):
+        path = Path(path)
+        with open(ImgTimeSeries.__metaPath__(path)) as f:
+            meta = json.load(f)
+        cube = np.load(path, mmap_mode=mmapMode)
+        if list(cube.shape) != meta['shape']:
+            raise ValueError("Time series cube not match its metadata: %s" % str(path))
+        return ImgTimeSeries(path, cube, meta)
+
+    @property
+    def shape(self):
+        return self.cube.shape
+
+    def scene(self, t):
+        return self.cube[t]
+
+    def iterBlocks(self, blockRows = None):
+        times, rows, cols, bands = self.cube.shape
+        if blockRows is None:
+            blockRows = max(1, int(ImgSpectral.blockPixels/max(1, times*cols*bands)))
+        for row in range(0, rows, int(blockRows)):
+            yield row, np.asarray(self.cube[:, row : row + int(blockRows)])
+
+    def reduce(self, function, blockRows = None, dtype = None):
+        out = None
+        for row, block in self.iterBlocks(blockRows):
+            result = function(block)
+            if out is None:
+                out = np.empty((self.cube.shape[1],) + result.shape[1:], dtype=result.dtype if dtype is None else dtype)
+                ImgMetrics.allocated(self.metrics, out)
+            out[row : row + result.shape[0]] = result
+        return out
+
+    def stats(self, names = None, blockRows = None):
+        names = ['mean', 'std', 'min', 'max', 'count'] if names is None else list(names)
+        for name in names:
+            if not name in ImgTimeSeries.statistics:
+                raise ValueError("Invalid statistic: %s" % name)
+        out = {}
+        with ImgMetrics.timer(self.metrics, 'timeseries.stats'):
+            for row, block in self.iterBlocks(blockRows):
+                block = block.astype(np.float64, copy=False) if np.issubdtype(block.dtype, np.integer) else block
+                with warnings.catch_warnings():
+                    # Pixeles sin ninguna fecha valida quedan en NaN
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    for name in names:
+                        result = ImgTimeSeries.statistics[name](block, axis=0)
+                        if not name in out:
+                            out[name] = np.empty((self.cube.shape[1],) + result.shape[1:], dtype=result.dtype)
+                        out[name][row : row + result.shape[0]] = result
+        return out
+
+#******************************** Intern Methods ************************************
+
+    @staticmethod
+    def __loadScene__(cube, t, path, bands, meta):
+        with ImgMetrics.timer(ImgTimeSeries.metrics, 'timeseries.scene'):
+            with ImgSpectral(path, meta['resizeFactor'], ImgTimeSeries.cache) as img:
+                datasets = img.__openBandsGroup__(bands)
+                if None in datasets:
+                    raise ValueError('Not dataset found for all solicited bands: %s' % path)
+                if len(datasets) > 1:
+                    ImgBandsGroup.__verifyDatasets__(datasets)
+                dataset = datasets[ImgBandsGroup.__reference__(datasets)]
+                if dataset.GetProjection() != meta['projection']:
+                    raise ValueError("Scene projection not match the time series grid: %s" % path)
+                window = ImgTimeSeries.__window__(dataset, meta)
+                if window is None:
+                    return False
+                (r0, r1, c0, c1), offset, aligned = window
+                if aligned:
+                    f = meta['resizeFactor']
+                    subset = (offset[0] + c0*f, offset[1] + r0*f, (c1 - c0)*f, (r1 - r0)*f)
+                    data = img.subset(subset, 'pixel').bandsGroup(bands)
+                else:
+                    data = ImgTimeSeries.__resample__(img, datasets, meta, (r0, r1, c0, c1))
+                data = np.asarray(data).reshape((r1 - r0, c1 - c0, len(bands)))
+                cube[t, r0 : r1, c0 : c1] = ImgTimeSeries.__mask__(data, datasets, cube.dtype)
+        return True
+
+    @staticmethod
+    def __window__(dataset, meta):
+        gt, out = dataset.GetGeoTransform(), meta['geoTransform']
+        rows, cols = meta['shape'][1:3]
+        # Posicion del origen de la grilla y tamaño de cada celda en pixeles de la escena
+        x, y = (out[0] - gt[0])/gt[1], (out[3] - gt[3])/gt[5]
+        sx, sy = out[1]/gt[1], out[5]/gt[5]
+        c0 = max(0, int(np.ceil(-x/sx - 1e-6)))
+        c1 = min(cols, int(np.floor((dataset.RasterXSize - x)/sx + 1e-6)))
+        r0 = max(0, int(np.ceil(-y/sy - 1e-6)))
+        r1 = min(rows, int(np.floor((dataset.RasterYSize - y)/sy + 1e-6)))
+        if c0 >= c1 or r0 >= r1:
+            return None
+        aligned = abs(sx - meta['resizeFactor']) < 1e-6 and abs(sy - meta['resizeFactor']) < 1e-6 and \
+            abs(x - round(x)) < 1e-6 and abs(y - round(y)) < 1e-6
+        return (r0, r1, c0, c1), (int(round(x)), int(round(y))), aligned
+
+    @staticmethod
+    def __resample__(img, datasets, meta, window):
+        r0, r1, c0, c1 = window
+        out = meta['geoTransform']
+        geometry = ImgBand.geometry(datasets[0:1], 1, None, 'pixel', ImgTimeSeries.verbose, **img.__options__())
+        data = np.empty((r1 - r0, c1 - c0, len(datasets)), dtype=geometry.storeDtype)
+        for i, dataset in enumerate(datasets):
+            gt = dataset.GetGeoTransform()
+            x, y = (out[0] + c0*out[1] - gt[0])/gt[1], (out[3] + r0*out[5] - gt[3])/gt[5]
+            xsize, ysize = (c1 - c0)*out[1]/gt[1], (r1 - r0)*out[5]/gt[5]
+            data[:, :, i] = geometry.__resample__(dataset, x, y, xsize, ysize, r1 - r0, c1 - c0)
+        return data
+
+    @staticmethod
+    def __mask__(data, datasets, dtype):
+        # Los pixeles sin datos dentro de la escena (valor nodata de la banda, o 0 si no lo
+        # declara) quedan como el relleno del cubo; con factor > 1 solo se detectan las
+        # celdas cuyo bloque de origen no tiene ningun dato valido
+        data = np.array(data, dtype=dtype)
+        for i, dataset in enumerate(datasets):
+            nodata = dataset.GetRasterBand(1).GetNoDataValue()
+            band = data[..., i]
+            band[band == (0 if nodata is None else nodata)] = ImgTimeSeries.__fill__(dtype)
+        return data
+
+    @staticmethod
+    def __fill__(dtype):
+        return np.nan if np.issubdtype(dtype, np.floating) else 0
+
+    @staticmethod
+    def __metaPath__(path):
+        return Path(path).with_name(Path(path).name + '.json')
+
+    @staticmethod
+    def __print__(message):
+        if ImgTimeSeries.verbose:
+            print(message)
@@ -1,6 +1,14 @@
 import numpy as np
-import gdal as gd
 from pathlib import Path
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from imgstats import ImgStats
+from imgcatalog import ImgCatalog
+from imgmetrics import ImgMetrics
+from imgcache import ImgCache
+from imglazy import ImgLazyModule
+
+gd = ImgLazyModule('gdal')
 
 class Multispectral:
 
@@ -28,6 +36,16 @@ class Multispectral:
     resizeFactor = 8
     cache = True
     verbose = False
+    loadEngine = 'block'            # 'block', 'decoder' (reduce en GDAL) o 'legacy'
+    workers = 1                     # Hilos para cargar bandas en paralelo
+    cacheMmap = None                # None carga el cache en memoria, 'r' o 'c' lo mapea con np.memmap
+    dtype = np.float64              # Tipo de los arrays en memoria y en cache (ej. np.uint16 o np.float32)
+    renderMode = 'float'            # 'float' devuelve imagenes en [0, 1], 'lut' devuelve uint8 usando una tabla
+    catalog = True                  # Indexar los archivos de bandas en un catalogo persistente
+    metrics = None                  # ImgMetrics para registrar tiempos, bytes y aciertos de cache
+    memoryCache = None              # ImgMemoryCache compartido por todas las escenas, None guarda los datos en cada instancia
+    computeDtype = np.float64       # Tipo usado para calcular los promedios
+    maxLoadMemory = 4000000         # Pixeles leidos por bloque en el motor 'block'
 
     RGBDinamicRange = .93
     colorSpacePower = .5
@@ -42,6 +60,7 @@ class Multispectral:
         self.resizeFactor = resizeFactor if not resizeFactor is None else Multispectral.resizeFactor
         self.cache = cache if not (cache is None) else Multispectral.cache
         self.cache = self.cache and not self.resizeFactor is None
+        self.workers = Multispectral.workers
         self.extension = path_split[-1]
         if not(self.extension in Multispectral.validExtensions) :
             raise ValueError('Invalid Path Extension')
@@ -50,74 +69,135 @@ class Multispectral:
             raise FileNotFoundError('Data Folder Not Exist') 
         self.config = Multispectral.extensionsConfig[self.extension]
         self.__selectBandsFiles__()
-        self.__openAllBandsGroups__()
+        self.datasets = {}
         cacheFolderName = str(self.resizeFactor)
-        self.pathCahe = self.pathFolder/'.multispectral/cache'/cacheFolderName
+        self.pathCahe = ImgCache.folder(self.pathFolder, '.multispectral/cache')/cacheFolderName
         self.__rgb__  = None
-        self.__vnir__ = None
-        self.__ublue__ = None
-        self.__pan__ = None
-        self.__bands__ = {}
+        self.__groups__ = {}
 
 #**********************************  User Methods ***********************************
 
     def band(self, band):
         band = str(band)
-        if not band in self.__bands__ :
-            ds = self.__openBandsGroup__([band])
-            self.__bands__[band] = self.__loadDataGroup__('band' + band, ds)[:,:,0] 
-        return self.__bands__[band]
+        return self.__memoized__('band' + band, lambda: self.__loadDataGroup__('band' + band, [band])[:,:,0])
 
     def pan(self):
-        if self.__pan__ is None :
-            self.__pan__ = self.__loadDataGroup__('pan', self.panDataset)[:,:,0] 
-        return self.__pan__
+        return self.__memoized__('pan', lambda: self.__loadDataGroup__('pan', self.__configBands__('panBand'))[:,:,0])
 
     def ublue(self):
-        if self.__ublue__ is None :
-            self.__ublue__ = self.__loadDataGroup__('ublue', self.ublueDataset)[:,:,0] 
-        return self.__ublue__
+        return self.__memoized__('ublue', lambda: self.__loadDataGroup__('ublue', self.__configBands__('ublueBand'))[:,:,0])
 
     def vnir(self):
-        if self.__vnir__ is None :
-            self.__vnir__ = self.__loadDataGroup__('vnir', self.vnirDatasets)
-        return self.__vnir__
+        return self.__memoized__('vnir', lambda: self.__loadDataGroup__('vnir', self.__configBands__('vnirBands')))
+
+    @property
+    def vnirDatasets(self):
+        bands = self.__configBands__('vnirBands')
+        return None if bands is None else self.__openBandsGroup__(bands)
+
+    @property
+    def ublueDataset(self):
+        bands = self.__configBands__('ublueBand')
+        return None if bands is None else self.__openBandsGroup__(bands)
+
+    @property
+    def panDataset(self):
+        bands = self.__configBands__('panBand')
+        return None if bands is None else self.__openBandsGroup__(bands)
+
+    def close(self):
+        self.datasets.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def iterBlocks(self, bands, blockRows = None, prefetch = False):
+        datasets = self.__openBandsGroup__([str(band) for band in bands])
+        if None in datasets : raise ValueError('Not dataset found for all solicited data, verify data files')
+        factor = 1 if self.resizeFactor is None else int(self.resizeFactor)
+        rows, cols = int(datasets[0].RasterYSize/factor), int(datasets[0].RasterXSize/factor)
+        if blockRows is None:
+            blockRows = max(1, int(Multispectral.maxLoadMemory/(cols*factor**2*len(datasets))))
+        gt = datasets[0].GetGeoTransform()
+        starts = list(range(0, rows, int(blockRows)))
+        read = lambda row: self.__readBlock__(datasets, factor, row, min(row + blockRows, rows), cols)
+        blockGeoTransform = lambda row: (gt[0] + row*factor*gt[2], gt[1]*factor, gt[2]*factor, 
+            gt[3] + row*factor*gt[5], gt[4]*factor, gt[5]*factor)
+        if not prefetch:
+            for row in starts:
+                yield row, 0, blockGeoTransform(row), read(row)
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            task = executor.submit(read, starts[0]) if starts else None
+            for i in range(len(starts)):
+                block = task.result()
+                if i + 1 < len(starts):
+                    task = executor.submit(read, starts[i + 1])
+                yield starts[i], 0, blockGeoTransform(starts[i]), block
+
+    def convertCache(self, dtype = None):
+        dtype = self.dtype if dtype is None else dtype
+        for pathFile in ImgCache.folder(self.pathFolder, '.multispectral/cache').glob('*/*.npy'):
+            data = np.load(pathFile, mmap_mode='r')
+            if data.dtype == dtype:
+                continue
+            self.__print__('Converting %s to %s' % (str(pathFile), np.dtype(dtype).name))
+            converted = Multispectral.__store__(np.asarray(data), dtype)
+            del data
+            with ImgCache.lock(pathFile):
+                ImgCache.save(pathFile, converted)
 
     def rgb(self, cache = True):
         if self.__rgb__ is None or not cache:
             vnir = self.vnir()
-            self.__rgb__ = Multispectral.composite(vnir[:,:,2], vnir[:,:,1], vnir[:,:,0])   
+            statsPath, source = self.pathCahe/'vnir.rgb.json', self.pathCahe/'vnir.npy'
+            stats = ImgStats.load(statsPath, source) if self.cache else None
+            loaded = not stats is None
+            self.__rgb__, stats = Multispectral.__render__(np.dstack((vnir[:,:,2], vnir[:,:,1], vnir[:,:,0])), stats)
+            if self.cache and not loaded:
+                ImgStats.save(statsPath, stats, source)
         return self.__rgb__
     
     @staticmethod
-    def color(reflectance):
-        _img = np.interp(
-            Multispectral.__normalice__(reflectance), 
-            Multispectral.linearSpace, 
-            Multispectral.colorSpace)
-        return Multispectral.__maxDinamicRange__(_img)
+    def color(reflectance, stats = None):
+        with ImgMetrics.timer(Multispectral.metrics, 'render'):
+            return Multispectral.__render__(reflectance, stats)[0]
 
     @staticmethod
-    def composite(r, g, b):
-        _img = np.interp(
-            Multispectral.__normalice__(np.dstack((r, g, b))), 
-            Multispectral.linearSpace, 
-            Multispectral.colorSpace)
-        return Multispectral.__maxDinamicRange__(_img)
+    def composite(r, g, b, stats = None):
+        with ImgMetrics.timer(Multispectral.metrics, 'render'):
+            return Multispectral.__render__(np.dstack((r, g, b)), stats)[0]
 
 
 #******************************** Intern Methods ************************************
  
-    def __loadDataGroup__(self, cachePathFile, datasetGroup):
+    def __memoized__(self, name, load):
+        if self.memoryCache is None:
+            if not name in self.__groups__:
+                self.__groups__[name] = load()
+            return self.__groups__[name]
+        key = (str(self.pathFolder.resolve()), self.extension, self.resizeFactor, name, np.dtype(self.dtype).str)
+        return self.memoryCache.fetch(key, load)
+
+    def __loadDataGroup__(self, cachePathFile, bands):
         dataGroup = None
         if self.cache :
-            dataGroup = self.__loadFromCache__(cachePathFile)
+            dataGroup = self.__loadFromCache__(cachePathFile, bands)
         if dataGroup is None:
-            if None in datasetGroup : raise ValueError('Not dataset found for all solicited data, verify data files')
-            self.__print__('Loading %s %s image from Dataset...' % (self.pathFolder.name, cachePathFile))
-            dataGroup = self.__loadAtFactor__(datasetGroup, self.resizeFactor)
-            if self.cache :
-                self.__saveCache__(cachePathFile, dataGroup)
+            with ImgCache.lock(self.pathCahe/(cachePathFile + '.npy')) if self.cache else nullcontext():
+                if self.cache and (self.pathCahe/(cachePathFile + '.npy')).exists() :
+                    dataGroup = self.__loadFromCache__(cachePathFile, bands)
+                if dataGroup is None:
+                    datasetGroup = [None] if bands is None else self.__openBandsGroup__(bands)
+                    if None in datasetGroup : raise ValueError('Not dataset found for all solicited data, verify data files')
+                    self.__print__('Loading %s %s image from Dataset...' % (self.pathFolder.name, cachePathFile))
+                    dataGroup = self.__loadAtFactor__(datasetGroup, self.resizeFactor)
+                    if self.cache :
+                        self.__saveCache__(cachePathFile, dataGroup, bands)
         return dataGroup
 
     def __print__(self, message, end = '\n'):
@@ -125,57 +205,90 @@ class Multispectral:
             print(message, end=end)
 
     @staticmethod
-    def __normalice__(img):
-        _nan = max(-100, np.min(img))
-        _min = np.min(img[img > _nan])
-        _max = np.max(img)
+    def __render__(img, stats = None):
+        if Multispectral.renderMode == 'lut':
+            return Multispectral.__renderLut__(img, stats)
+        stats = ImgStats.range(img) if stats is None else dict(stats)
+        _img = np.interp(
+            Multispectral.__normalice__(img, stats), 
+            Multispectral.linearSpace, 
+            Multispectral.colorSpace)
+        if not 'low' in stats:
+            stats.update(ImgStats.clipPoints(_img, Multispectral.RGBDinamicRange))
+        return Multispectral.__maxDinamicRange__(_img, stats), stats
+
+    @staticmethod
+    def __renderLut__(img, stats = None):
+        stats = ImgStats.range(img) if stats is None else dict(stats)
+        index, values = ImgStats.quantize(img, stats)
+        curve = np.interp(
+            np.clip((values - stats['min'])/(stats['max'] - stats['min']), 0, 1),
+            Multispectral.linearSpace, 
+            Multispectral.colorSpace)
+        if not 'low' in stats:
+            counts = ImgStats.counts(index, len(curve))
+            counts[:, curve <= 0] = 0
+            levels = np.arange(len(curve) + 1)
+            low = min(ImgStats.quantile(c, levels, 1 - Multispectral.RGBDinamicRange) for c in counts)
+            high = max(ImgStats.quantile(c, levels, Multispectral.RGBDinamicRange) for c in counts)
+            top = np.nonzero(counts.sum(axis=0))[0]
+            stats.update({
+                'low' : float(np.interp(low, levels[:-1], curve)),
+                'high' : float(np.interp(high, levels[:-1], curve)),
+                'top' : float(curve[top[-1]]) if top.size > 0 else 1.0})
+        lut = np.interp(curve, (0, stats['low'], stats['high'], stats['top']), (0, .1, .9, 1))
+        lut = np.rint(lut*255).astype(np.uint8)
+        return lut[index], stats
+
+    @staticmethod
+    def __normalice__(img, stats = None):
+        stats = ImgStats.range(img) if stats is None else stats
+        _min, _max = stats['min'], stats['max']
         return np.clip((img - _min)/(_max - _min), 0,1 )
 
     @staticmethod
-    def __maxDinamicRange__(img): 
-        if len(img.shape) == 3:
-            mins = np.zeros(img.shape[2])
-            maxs = np.zeros(img.shape[2])
-            for i in range(img.shape[2]):
-                relevant = img[:,:,i][img[:,:,i] > 0]
-                mins[i] = np.quantile(relevant , 1 - Multispectral.RGBDinamicRange)
-                maxs[i] = np.quantile(relevant, Multispectral.RGBDinamicRange)
-            _min = np.min(mins)
-            _max = np.max(maxs)
-        else :
-            relevant = img[img > 0]
-            _min = np.quantile(relevant , 1 - Multispectral.RGBDinamicRange)
-            _max = np.quantile(relevant, Multispectral.RGBDinamicRange)
+    def __maxDinamicRange__(img, stats = None): 
+        stats = ImgStats.clipPoints(img, Multispectral.RGBDinamicRange) if stats is None else stats
         return np.interp(img, 
-        (0, _min, _max, np.max(img)), 
+        (0, stats['low'], stats['high'], stats['top']), 
         (0, .1, .9, 1))
 
     def __openBandsGroup__(self, bands):
         datasets = []
         for band in bands:
-            bandPath = self.__findBandPathFile__(band)
-            if bandPath is None:
-                self.__print__('Warning: %s band %s not Found...' % (self.pathFolder.name, band))
-                datasets.append(None)
-            else :
-                datasets.append(gd.Open(str(self.pathFolder/bandPath) )) 
+            if not band in self.datasets:
+                bandPath = self.__findBandPathFile__(band)
+                if bandPath is None:
+                    self.__print__('Warning: %s band %s not Found...' % (self.pathFolder.name, band))
+                    datasets.append(None)
+                    continue
+                self.datasets[band] = gd.Open(str(self.pathFolder/bandPath))
+            datasets.append(self.datasets[band])
         return datasets
 
-    def __openAllBandsGroups__(self):
-        if 'vnirBands' in self.config:
-            self.vnirDatasets = self.__openBandsGroup__(self.config['vnirBands'])
-        else :
-            self.vnirDatasets = None
-        if 'ublueBand' in self.config:
-            self.ublueDataset = self.__openBandsGroup__([self.config['ublueBand']])
-        else :
-            self.ublueDataset = None
-        if 'panBand' in self.config:
-            self.panDataset = self.__openBandsGroup__([self.config['panBand']])
-        else :
-            self.panDataset = None
+    def __sources__(self, bands):
+        if bands is None:
+            return None
+        paths = [self.__findBandPathFile__(band) for band in bands]
+        return None if None in paths else [self.pathFolder/path for path in paths]
+
+    def __configBands__(self, key):
+        if not key in self.config:
+            return None
+        bands = self.config[key]
+        return list(bands) if isinstance(bands, list) else [bands]
 
     def __selectBandsFiles__(self):
+        self.bandsIndex = None
+        if self.catalog:
+            extensions = [self.config['bandsExtension'], self.config['bandsExtension'].upper()]
+            catalog = ImgCatalog.get(self.pathFolder, extensions)
+            self.bandsFilesExtension = extensions[0] if len(catalog.files[extensions[0]]) > 0 else extensions[1]
+            if len(catalog.files[self.bandsFilesExtension]) == 0:
+                raise ValueError('Bands Files Not found')
+            key = 'multispectral' + self.bandsFilesExtension + self.config['nameSeparator'] + ','.join(self.config['bandsPrefixes'])
+            self.bandsIndex = catalog.index(key, self.__indexBandsFiles__)
+            return
         filesNames = []
         self.bandsFilesExtension = self.config['bandsExtension']
         paths = list(self.pathFolder.glob('**/*.' + self.bandsFilesExtension))
@@ -188,7 +301,18 @@ class Multispectral:
             filesNames.append(path.name.split('.')[0])
         self.bandsFilesNames = filesNames
 
+    def __indexBandsFiles__(self, catalog):
+        index = {}
+        for prefix in self.config['bandsPrefixes'] :
+            for path in catalog.files[self.bandsFilesExtension]:
+                part = Path(path).name.split('.')[0].split(self.config['nameSeparator'])[-1]
+                if part.startswith(prefix) and len(part) > len(prefix):
+                    index.setdefault(part[len(prefix):], path)
+        return index
+
     def __findBandPathFile__(self, bandName):
+        if not self.bandsIndex is None:
+            return self.bandsIndex.get(bandName)
         filesBands = []
         for fileName in self.bandsFilesNames:
             filesBands.append(fileName.split(self.config['nameSeparator'])[-1])
@@ -198,24 +322,119 @@ class Multispectral:
         return None
 
     def __loadAtFactor__(self, datasets, factor) :
+        if factor is None or self.loadEngine == 'legacy':
+            return self.__loadAtFactorLegacy__(datasets, factor)
+        if not self.loadEngine in ('block', 'decoder'):
+            raise ValueError('Invalid load engine')
+        return self.__loadAtFactorBlocks__(datasets, factor)
+
+    def __loadAtFactorBlocks__(self, datasets, factor) :
+        for ds in datasets : 
+            if not ds is None : break
+        inSize = np.array((ds.RasterYSize, ds.RasterXSize))
+        outSize = np.floor(inSize/factor).astype(int)
+        out = self.__allocate__(outSize.tolist() + [len(datasets)])
+        workers = min(self.workers, len(datasets))
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                tasks = [executor.submit(self.__loadBandAtFactor__, datasets[d], factor, out[:,:,d])
+                    for d in range(len(datasets))]
+                for task in tasks : task.result()
+        else:
+            for d in range(len(datasets)) :
+                self.__loadBandAtFactor__(datasets[d], factor, out[:,:,d], (d, len(datasets)))
+        return out
+
+    def __loadBandAtFactor__(self, dataset, factor, out, progress = None) :
+        blockRows = max(1, int(Multispectral.maxLoadMemory/(out.shape[1]*factor**2)))
+        row = int(0)
+        while row < out.shape[0] :
+            rows = int(min(blockRows, out.shape[0] - row))
+            data = self.__readRows__(dataset, factor, row, row + rows, int(out.shape[1]))
+            out[row : row + rows, :] = Multispectral.__store__(data, out.dtype)
+            row += rows
+            if not progress is None:
+                loaded = (progress[0] + row/out.shape[0])/progress[1]
+                self.__print__('  loaded {:.0f} %'.format(loaded*100.0), end = '\r')
+
+    def __readRows__(self, dataset, factor, row, end, cols) :
+        if factor > 1 and self.loadEngine == 'decoder':
+            bufType = gd.GDT_Float32 if np.dtype(self.computeDtype) == np.float32 else gd.GDT_Float64
+            with ImgMetrics.timer(self.metrics, 'decode'):
+                data = dataset.ReadAsArray(0, row*factor, cols*factor, (end - row)*factor,
+                    buf_xsize=cols, buf_ysize=end - row, buf_type=bufType, resample_alg=gd.GRIORA_Average)
+            if not self.metrics is None:
+                ImgMetrics.count(self.metrics, 'gdal.bytesRead', Multispectral.__windowBytes__(dataset, cols*factor, (end - row)*factor))
+            return data
+        with ImgMetrics.timer(self.metrics, 'decode'):
+            raw = dataset.ReadAsArray(0, row*factor, cols*factor, (end - row)*factor)
+        ImgMetrics.count(self.metrics, 'gdal.bytesRead', raw.nbytes)
+        if factor == 1:
+            return raw
+        with ImgMetrics.timer(self.metrics, 'reduce'):
+            return Multispectral.__blockMean__(raw, factor, self.computeDtype)
+
+    def __readBlock__(self, datasets, factor, row, end, cols) :
+        block = None
+        for d in range(len(datasets)) :
+            raw = self.__readRows__(datasets[d], factor, row, end, cols)
+            data = raw if factor == 1 else Multispectral.__store__(raw, self.dtype)
+            if block is None:
+                block = np.empty(data.shape + (len(datasets),), dtype=data.dtype)
+            block[:,:,d] = data
+        return block
+
+    @staticmethod
+    def __windowBytes__(dataset, xsize, ysize):
+        return int(xsize)*int(ysize)*int(gd.GetDataTypeSize(dataset.GetRasterBand(1).DataType)/8)
+
+    @staticmethod
+    def __blockMean__(raw, factor, dtype = None):
+        rows, cols = int(raw.shape[0]/factor), int(raw.shape[1]/factor)
+        return raw.reshape((rows, factor, cols, factor)).mean(axis=(1, 3), dtype=dtype)
+
+    @staticmethod
+    def __store__(data, dtype):
+        if np.issubdtype(dtype, np.integer) and not np.can_cast(data.dtype, dtype):
+            # Redondear y saturar en el rango del tipo entero en lugar de desbordar
+            if not np.issubdtype(data.dtype, np.integer):
+                data = np.rint(data)
+            data = np.clip(data, np.iinfo(dtype).min, np.iinfo(dtype).max)
+        return data.astype(dtype, copy=False)
+
+    def __allocate__(self, shape):
+        if np.issubdtype(self.dtype, np.floating):
+            out = np.full(shape, np.nan, dtype=self.dtype)
+        else:
+            out = np.zeros(shape, dtype=self.dtype)
+        ImgMetrics.allocated(self.metrics, out)
+        return out
+
+    def __loadAtFactorLegacy__(self, datasets, factor) :
         for ds in datasets : 
             if not ds is None : break
         inSize = np.array((ds.RasterYSize, ds.RasterXSize))
         outSize = inSize if factor is None else np.floor(inSize/factor).astype(int)
-        out = np.full(outSize.tolist() + [len(datasets)], np.nan)
+        out = self.__allocate__(outSize.tolist() + [len(datasets)])
         w_pix = None if factor is None else int(min(5000, 500000/factor**2))
         for d in range(len(datasets)) :
             loaded = d/len(datasets)
             if factor is None:
-                out[:,:,d] = datasets[d].ReadAsArray()
+                with ImgMetrics.timer(self.metrics, 'decode'):
+                    raw = datasets[d].ReadAsArray()
+                ImgMetrics.count(self.metrics, 'gdal.bytesRead', raw.nbytes)
+                out[:,:,d] = Multispectral.__store__(raw, out.dtype)
                 continue
             xoff = yoff = int(0)
             while yoff < out.shape[1] : 
                 width = int(min(inSize[0]- xoff * factor, factor * w_pix))
-                w = datasets[d].ReadAsArray(yoff * factor, xoff * factor, factor, width)
+                with ImgMetrics.timer(self.metrics, 'decode'):
+                    w = datasets[d].ReadAsArray(yoff * factor, xoff * factor, factor, width)
+                ImgMetrics.count(self.metrics, 'gdal.bytesRead', w.nbytes)
                 steps = int(width/factor)
-                for i in range(steps):
-                    out[xoff + i, yoff, d] = np.mean(w[i*factor:i*factor + factor, :])
+                with ImgMetrics.timer(self.metrics, 'reduce'):
+                    means = np.array([np.mean(w[i*factor:i*factor + factor, :], dtype=self.computeDtype) for i in range(steps)])
+                out[xoff : xoff + steps, yoff, d] = Multispectral.__store__(means, out.dtype)
                 xoff = xoff + w_pix
                 if xoff >= out.shape[0] : 
                     xoff, yoff = 0, yoff + 1
@@ -223,13 +442,18 @@ class Multispectral:
                     self.__print__('  loaded {:.0f} %'.format(loaded*100.0), end = '\r')
         return out
 
-    def __loadFromCache__(self, filePath) :
-        if not (self.pathCahe/(filePath + '.npy')).exists() :
+    def __loadFromCache__(self, filePath, bands = None) :
+        with ImgMetrics.timer(self.metrics, 'cache.read'):
+            data = ImgCache.load(self.pathCahe/(filePath + '.npy'), self.cacheMmap, self.__sources__(bands))
+        if data is None :
+            ImgMetrics.count(self.metrics, 'cache.miss')
             return None
         self.__print__('Loading %s %s data from Cache' % (self.pathFolder.name, filePath))
-        return np.load(self.pathCahe/(filePath + '.npy'))
+        ImgMetrics.count(self.metrics, 'cache.hit')
+        ImgMetrics.count(self.metrics, 'cache.bytesRead', data.nbytes)
+        return data if data.dtype == self.dtype else Multispectral.__store__(data, self.dtype)
         
-    def __saveCache__(self, filePath, data) :
-        if not self.pathCahe.exists() : 
-            self.pathCahe.mkdir(parents = True, exist_ok=True)
-        np.save(self.pathCahe/(filePath + '.npy'), data)
+    def __saveCache__(self, filePath, data, bands = None) :
+        with ImgMetrics.timer(self.metrics, 'cache.write'):
+            ImgCache.save(self.pathCahe/(filePath + '.npy'), data, self.__sources__(bands))
+        ImgMetrics.count(self.metrics, 'cache.bytesWritten', data.nbytes)
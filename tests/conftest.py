@@ -0,0 +1,168 @@
+import sys
+import types
+import numpy as np
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import imgspectral
+import multispectral
+from imgcache import ImgCache
+from imgcatalog import ImgCatalog
+
+#****************************** GDAL de prueba ******************************************
+
+class FakeBand:
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def GetOverviewCount(self):
+        return 0
+
+    def GetNoDataValue(self):
+        return self.dataset.nodata
+
+    @property
+    def DataType(self):
+        return self.dataset.arr.dtype
+
+
+class FakeDataset:
+
+    def __init__(self, arr, gt = (500000.0, 10.0, 0.0, 1000000.0, 0.0, -10.0), projection = 'PROJ', name = 'band.tif', nodata = None):
+        self.arr = np.asarray(arr)
+        self.gt = tuple(gt)
+        self.projection = projection
+        self.name = name
+        self.nodata = nodata
+        self.RasterYSize, self.RasterXSize = self.arr.shape
+        self.reads = 0
+
+    def GetGeoTransform(self):
+        return self.gt
+
+    def GetProjection(self):
+        return self.projection
+
+    def GetRasterBand(self, i):
+        return FakeBand(self)
+
+    def GetDriver(self):
+        return types.SimpleNamespace(ShortName='GTiff')
+
+    def GetDescription(self):
+        return self.name
+
+    def ReadAsArray(self, xoff = 0, yoff = 0, xsize = None, ysize = None, buf_xsize = None, buf_ysize = None,
+                    buf_type = None, resample_alg = None, **kw):
+        self.reads += 1
+        xsize = self.RasterXSize if xsize is None else xsize
+        ysize = self.RasterYSize if ysize is None else ysize
+        if xoff < 0 or yoff < 0 or xoff + xsize > self.RasterXSize or yoff + ysize > self.RasterYSize:
+            raise RuntimeError('Access window out of range in RasterIO()')
+        data = self.arr[yoff : yoff + ysize, xoff : xoff + xsize]
+        if buf_xsize is None:
+            return data.copy()
+        # Promedio por area como GRIORA_Average, con pesos para celdas fraccionarias
+        rows = FakeDataset.__weights__(ysize, buf_ysize)
+        cols = FakeDataset.__weights__(xsize, buf_xsize)
+        return rows @ data.astype(np.float64) @ cols.T
+
+    @staticmethod
+    def __weights__(size, out):
+        edges = np.linspace(0, size, out + 1)
+        weights = np.zeros((out, size))
+        for i in range(out):
+            for p in range(int(np.floor(edges[i])), int(np.ceil(edges[i + 1]))):
+                weights[i, p] = min(edges[i + 1], p + 1) - max(edges[i], p)
+        return weights/weights.sum(axis=1, keepdims=True)
+
+
+class FakeGdal(types.ModuleType):
+
+    GDT_Float32 = 6
+    GDT_Float64 = 7
+    GRIORA_Average = 5
+
+    def __init__(self):
+        types.ModuleType.__init__(self, 'gdal')
+        self.datasets = {}
+        self.opened = []
+
+    @staticmethod
+    def GetDataTypeSize(dataType):
+        return np.dtype(dataType).itemsize*8
+
+    def Open(self, path, *args):
+        self.opened.append(str(path))
+        dataset = self.datasets.get(str(path))
+        if dataset is None:
+            raise RuntimeError('%s: No such file or directory' % path)
+        return dataset
+
+class FakeTransform:
+
+    # Grados iguales a metros: suficiente para ubicar subsets 'latlon' sin osgeo
+    def TransformPoint(self, a, b, z = 0):
+        return (a, b, z)
+
+
+class FakeOsr(types.ModuleType):
+
+    def __init__(self):
+        types.ModuleType.__init__(self, 'osr')
+        self.transforms = 0
+
+    @staticmethod
+    def SpatialReference():
+        return types.SimpleNamespace(ImportFromWkt=lambda wkt: 0, CloneGeogCS=lambda: None)
+
+    def CoordinateTransformation(self, source, target):
+        self.transforms += 1
+        return FakeTransform()
+
+#******************************** Fixtures **********************************************
+
+@pytest.fixture
+def cache(monkeypatch):
+    # Aisla el manifiesto y los catalogos de cada prueba
+    monkeypatch.setattr(ImgCache, 'root', None)
+    monkeypatch.setattr(ImgCache, 'manifestFile', None)
+    monkeypatch.setattr(ImgCache, 'budget', None)
+    monkeypatch.setattr(ImgCache, '__manifestCache__', {})
+    monkeypatch.setattr(ImgCache, '__touches__', {})
+    ImgCatalog.clear()
+    yield ImgCache
+    ImgCatalog.clear()
+
+
+@pytest.fixture
+def gdal(monkeypatch, cache):
+    fake = FakeGdal()
+    monkeypatch.setattr(imgspectral, 'gd', fake)
+    monkeypatch.setattr(multispectral, 'gd', fake)
+    fake.osr = FakeOsr()
+    monkeypatch.setattr(imgspectral, 'osr', fake.osr)
+    return fake
+
+
+@pytest.fixture
+def makeScene(gdal, tmp_path):
+    # Crea una carpeta de escena con un archivo vacio por banda y registra sus datasets
+    def make(bands, name = 'scene', sensor = 'landsat8', prefix = 'LC08_B', extension = 'tif', **dataset):
+        folder = tmp_path/name
+        folder.mkdir(parents = True, exist_ok=True)
+        for band, value in bands.items():
+            path = folder/('%s%s.%s' % (prefix, band, extension))
+            path.touch()
+            arr, options = value if isinstance(value, tuple) else (value, {})
+            gdal.datasets[str(path)] = FakeDataset(arr, name=str(path), **dict(dataset, **options))
+        return str(folder) + '.' + sensor
+    return make
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
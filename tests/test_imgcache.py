@@ -0,0 +1,235 @@
+import os
+import sys
+import threading
+import subprocess
+import numpy as np
+from pathlib import Path
+import pytest
+from imgcache import ImgCache
+from imgcatalog import ImgCatalog
+
+
+@pytest.fixture
+def folder(cache, tmp_path):
+    folder = tmp_path/'cache'
+    folder.mkdir()
+    return folder
+
+
+def test_write_is_atomic(folder):
+    path = folder/'entry.npy'
+    ImgCache.save(path, np.arange(10))
+    def fail(f):
+        f.write(b'partial')
+        raise RuntimeError('disk full')
+    with pytest.raises(RuntimeError):
+        ImgCache.write(path, fail)
+    np.testing.assert_array_equal(ImgCache.load(path), np.arange(10))
+    assert not any(p.name.endswith('.tmp') for p in folder.iterdir())
+
+
+def test_truncated_entry_is_discarded(folder):
+    path = folder/'entry.npy'
+    ImgCache.save(path, np.arange(100.0))
+    path.with_name('entry.meta.json').write_text('{}')
+    with open(path, 'r+b') as f:
+        f.truncate(path.stat().st_size - 8)
+    assert not ImgCache.valid(path)
+    assert ImgCache.load(path) is None
+    assert not path.exists() and not path.with_name('entry.meta.json').exists()
+
+
+HOLD = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+from imgcache import ImgCache
+with ImgCache.lock(sys.argv[2]):
+    print('locked', flush=True)
+    sys.stdin.readline()
+"""
+
+
+def hold(path):
+    process = subprocess.Popen([sys.executable, '-c', HOLD, str(Path(__file__).resolve().parent.parent), str(path)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    assert process.stdout.readline().strip() == 'locked'
+    return process
+
+
+def release(process):
+    process.stdin.write('\n')
+    process.stdin.flush()
+    process.wait(10)
+
+
+def test_lock_file_is_removed_only_when_free(folder):
+    path = folder/'entry.npy'
+    with ImgCache.lock(path):
+        ImgCache.save(path, np.arange(10))
+        ImgCache.remove(path)
+        assert path.with_name('entry.npy.lock').exists()
+    ImgCache.save(path, np.arange(10))
+    process = hold(path)
+    ImgCache.remove(path)
+    assert path.with_name('entry.npy.lock').exists()
+    release(process)
+    ImgCache.save(path, np.arange(10))
+    ImgCache.remove(path)
+    assert list(folder.glob('entry*')) == []
+
+
+def test_removing_an_entry_keeps_the_lock_exclusive(folder):
+    path = folder/'entry.npy'
+    ImgCache.save(path, np.arange(10))
+    process = hold(path)
+    ImgCache.remove(path)
+    entered = threading.Event()
+    def enter():
+        with ImgCache.lock(path):
+            entered.set()
+    thread = threading.Thread(target=enter)
+    thread.start()
+    assert not entered.wait(.5)
+    release(process)
+    thread.join(10)
+    assert entered.is_set()
+
+
+def test_thread_locks_are_released(folder):
+    for i in range(20):
+        with ImgCache.lock(folder/('entry%d.npy' % i)):
+            pass
+    assert ImgCache.__threadLocks__ == {}
+
+
+def test_catalog_is_written_atomically(folder, monkeypatch):
+    (folder/'B4.tif').touch()
+    written = []
+    write = ImgCache.write
+    monkeypatch.setattr(ImgCache, 'write', lambda path, writer: written.append(path) or write(path, writer))
+    ImgCatalog.get(folder, ['tif']).index('bands', lambda catalog: ['B4'])
+    assert len(written) > 0 and set(written) == {folder/ImgCatalog.fileName}
+    ImgCatalog.clear()
+    assert ImgCatalog.get(folder, ['tif']).index('bands', lambda catalog: None) == ['B4']
+
+
+def test_manifest_lives_next_to_the_cache(folder, tmp_path, monkeypatch):
+    ImgCache.save(folder/'entry.npy', np.arange(10))
+    assert (folder/'manifest.json.log').exists()
+    monkeypatch.setattr(ImgCache, 'root', str(tmp_path/'root'))
+    ImgCache.save(folder/'other.npy', np.arange(10))
+    assert (tmp_path/'root'/'manifest.json.log').exists()
+
+
+def test_manifest_journal_is_compacted(folder, monkeypatch):
+    monkeypatch.setattr(ImgCache, 'journalEntries', 3)
+    for i in range(5):
+        ImgCache.save(folder/('entry%d.npy' % i), np.arange(10))
+    assert (folder/'manifest.json').exists()
+    monkeypatch.setattr(ImgCache, '__manifestCache__', {})
+    assert len(ImgCache.__readManifest__(folder/'manifest.json')) == 5
+
+
+def test_touches_are_batched(folder, monkeypatch):
+    monkeypatch.setattr(ImgCache, 'touchInterval', 3600)
+    path = folder/'entry.npy'
+    ImgCache.save(path, np.arange(10))
+    journal = (folder/'manifest.json.log').read_text()
+    for i in range(5):
+        ImgCache.load(path)
+    assert (folder/'manifest.json.log').read_text() == journal
+    ImgCache.flush()
+    accessed = ImgCache.__readManifest__(folder/'manifest.json')[ImgCache.__key__(path)]['accessed']
+    assert len((folder/'manifest.json.log').read_text()) > len(journal) and accessed > 0
+
+
+def test_unknown_entries_older_than_sources_are_a_plain_miss(folder):
+    source = folder/'B4.tif'
+    path = folder/'entry.npy'
+    np.save(path, np.arange(10))
+    source.write_bytes(b'band')
+    os.utime(source, ns=(path.stat().st_mtime_ns + 10**9,)*2)
+    assert ImgCache.load(path, sources=[source]) is None
+    assert path.exists() and ImgCache.__entry__(path) is None
+    ImgCache.save(path, np.arange(5), [source])
+    np.testing.assert_array_equal(ImgCache.load(path, sources=[source]), np.arange(5))
+
+
+def test_entries_written_before_the_manifest_are_adopted(folder):
+    source = folder/'B4.tif'
+    source.write_bytes(b'band')
+    path = folder/'entry.npy'
+    np.save(path, np.arange(10, dtype=np.uint16))
+    os.utime(path, ns=(source.stat().st_mtime_ns + 10**9,)*2)
+    np.testing.assert_array_equal(ImgCache.load(path, sources=[source]), np.arange(10))
+    entry = ImgCache.__entry__(path)
+    assert entry['dtype'] == np.dtype(np.uint16).str and entry['shape'] == [10]
+    source.write_bytes(b'new band')
+    assert ImgCache.load(path, sources=[source]) is None and not path.exists()
+
+
+def test_save_registers_the_entry_before_replacing_the_file(folder, monkeypatch):
+    path = folder/'entry.npy'
+    seen = []
+    replace = os.replace
+    def check(source, target):
+        if Path(target) == path:
+            seen.append(ImgCache.__entry__(path))
+        replace(source, target)
+    monkeypatch.setattr(os, 'replace', check)
+    ImgCache.save(path, np.arange(10))
+    assert len(seen) == 1 and seen[0]['shape'] == [10]
+
+
+def test_stale_discard_keeps_a_newer_entry(folder):
+    source = folder/'B4.tif'
+    source.write_bytes(b'band')
+    path = folder/'entry.npy'
+    ImgCache.save(path, np.arange(10), [source])
+    stale = ImgCache.__entry__(path)
+    source.write_bytes(b'new band')
+    ImgCache.save(path, np.arange(3), [source])
+    ImgCache.__discardStale__(path, stale)
+    np.testing.assert_array_equal(ImgCache.load(path, sources=[source]), np.arange(3))
+
+
+def test_changed_sources_discard_entry_and_sidecars(folder):
+    source = folder/'B4.tif'
+    source.write_bytes(b'band')
+    path = folder/'entry.npy'
+    ImgCache.save(path, np.arange(10), [source])
+    sidecars = [folder/name for name in ('entry.meta.json', 'entry.stats.json', 'entry.rgb.json')]
+    for sidecar in sidecars:
+        sidecar.write_text('{}')
+    source.write_bytes(b'new band')
+    assert ImgCache.load(path, sources=[source]) is None
+    assert not path.exists() and not any(sidecar.exists() for sidecar in sidecars)
+
+
+def test_budget_evicts_least_recently_used(folder, monkeypatch):
+    monkeypatch.setattr(ImgCache, 'touchInterval', 0)
+    paths = [folder/('entry%d.npy' % i) for i in range(3)]
+    for path in paths[0:2]:
+        ImgCache.save(path, np.zeros(1000))
+        path.with_name(path.stem + '.rgb.json').write_text('{}')
+    ImgCache.load(paths[0])
+    monkeypatch.setattr(ImgCache, 'budget', 2*paths[0].stat().st_size)
+    ImgCache.save(paths[2], np.zeros(1000))
+    assert paths[0].exists() and paths[2].exists()
+    assert not paths[1].exists() and not (folder/'entry1.rgb.json').exists()
+    assert ImgCache.evict(0, folder) > 0
+    assert list(folder.glob('entry*')) == []
+
+
+def test_scene_cache_is_rebuilt_when_sources_change(makeScene, gdal, rng):
+    from imgspectral import ImgSpectral
+    b4 = rng.integers(1, 60000, (40, 48)).astype(np.uint16)
+    path = makeScene({'4' : b4})
+    first = np.asarray(ImgSpectral(path, 4, True).band(4)).copy()
+    source = next(iter(gdal.datasets))
+    gdal.datasets[source].arr = b4[::-1].copy()
+    with open(source, 'wb') as f:
+        f.write(b'changed')
+    second = ImgSpectral(path, 4, True).band(4)
+    np.testing.assert_allclose(second, b4[::-1].reshape((10, 4, 12, 4)).mean(axis=(1, 3)))
+    assert not np.array_equal(first, second)
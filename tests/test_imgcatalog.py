@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import pytest
+from imgcatalog import ImgCatalog
+from imgspectral import ImgSpectral
+from multispectral import Multispectral
+
+
+def scene(tmp_path, names):
+    folder = tmp_path/'scene'
+    for name in names:
+        (folder/name).parent.mkdir(parents = True, exist_ok=True)
+        (folder/name).touch()
+    return folder
+
+
+def bump(folder):
+    # Garantiza un mtime distinto aunque el sistema de archivos tenga poca resolucion
+    mtime = os.stat(folder).st_mtime_ns + 10**9
+    os.utime(folder, ns=(mtime, mtime))
+
+
+def lookup(cls, path, bands, catalog, monkeypatch):
+    monkeypatch.setattr(cls, 'catalog', catalog)
+    img = cls(path, 4, False)
+    return [img.__findBandPathFile__(band) for band in bands]
+
+
+@pytest.mark.parametrize('cls, names, bands', [
+    (ImgSpectral, ['LC08_B4.tif', 'LC08_B04.TIF', 'LC08_band5.TIF', 'LC08_B10.tif', 'LC08_B1_x.tif', 'notes.txt'],
+        ['1', '4', '04', '5', '10', '0', '3']),
+    (Multispectral, ['LC08_B04.tif', 'LC08_band4.tif', 'LC08_B5.tif', 'LC08_x_B6.tif', 'LC08_B10.tif'],
+        ['4', '04', '5', '6', '10', '0', '7']),
+])
+def test_catalog_matches_the_glob_lookup(cache, tmp_path, monkeypatch, cls, names, bands):
+    path = str(scene(tmp_path, names)) + '.landsat8'
+    expected = lookup(cls, path, bands, False, monkeypatch)
+    assert lookup(cls, path, bands, True, monkeypatch) == expected
+    assert expected.count(None) == 2
+    ImgCatalog.clear()
+    assert lookup(cls, path, bands, True, monkeypatch) == expected
+
+
+@pytest.mark.parametrize('cls', [ImgSpectral, Multispectral])
+def test_catalog_is_rebuilt_when_a_folder_changes(cache, tmp_path, cls):
+    folder = scene(tmp_path, ['LC08_B4.tif', 'sub/LC08_B5.tif'])
+    path = str(folder) + '.landsat8'
+    assert cls(path, 4, False).__findBandPathFile__('3') is None
+    (folder/'LC08_B3.tif').touch()
+    bump(folder)
+    assert cls(path, 4, False).__findBandPathFile__('3') == 'LC08_B3.tif'
+    (folder/'sub'/'LC08_B2.tif').touch()
+    bump(folder/'sub')
+    ImgCatalog.clear()
+    assert cls(path, 4, False).__findBandPathFile__('2') == os.path.join('sub', 'LC08_B2.tif')
+
+
+@pytest.mark.parametrize('cls', [ImgSpectral, Multispectral])
+def test_bands_in_subfolders_are_opened(makeScene, tmp_path, rng, cls):
+    b4 = rng.integers(1, 60000, (40, 48)).astype(np.uint16)
+    makeScene({'4' : b4}, name='scene/data')
+    folder = scene(tmp_path, ['LC08_B5.tif', '.imgspectral/LC08_B3.tif'])
+    img = cls(str(folder) + '.landsat8', 4, False)
+    assert img.__findBandPathFile__('3') is None
+    np.testing.assert_allclose(img.band(4), b4.reshape((10, 4, 12, 4)).mean(axis=(1, 3)))
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+from imgindex import ImgIndex
+
+
+@pytest.fixture
+def block(rng):
+    return rng.random((12, 9, 3)).astype(np.float32) + .1
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('(B8 - B4)/(B8 + B4)', lambda b4, b8, b11: (b8 - b4)/(b8 + b4)),
+    ('2.5*(B8 - B4)/(B8 + 6*B4 - 7.5*B11 + 1)', lambda b4, b8, b11: 2.5*(b8 - b4)/(b8 + 6*b4 - 7.5*b11 + 1)),
+    ('-B4 + B8**2 - +B11', lambda b4, b8, b11: -b4 + b8**2 - b11),
+    ('(B11 - B8)/(B11 + B8)*(B4 - B4 + 1)', lambda b4, b8, b11: (b11 - b8)/(b11 + b8)),
+])
+def test_evaluate_matches_numpy(block, expression, expected):
+    program = ImgIndex(expression)
+    bands = dict(zip(('4', '8', '11'), np.moveaxis(block, 2, 0)))
+    stack = np.dstack([bands[band] for band in program.bands])
+    out = np.empty(block.shape[0:2], dtype=ImgIndex.dtype)
+    program.evaluate(stack, out)
+    np.testing.assert_allclose(out, expected(bands['4'], bands['8'], bands['11']), rtol=1e-5)
+
+
+def test_bands_are_listed_once_in_order():
+    assert ImgIndex('(b8 - B4)/(B8 + b4)').bands == ['8', '4']
+
+
+def test_registers_are_reused():
+    program = ImgIndex('((B1 + B2)*(B3 + B4)) + ((B5 + B6)*(B7 + B8))')
+    assert program.registers <= 3
+
+
+def test_single_band_expression_copies_the_band(block):
+    out = np.empty(block.shape[0:2], dtype=ImgIndex.dtype)
+    ImgIndex('B5').evaluate(block, out)
+    np.testing.assert_array_equal(out, block[:,:,0])
+
+
+@pytest.mark.parametrize('expression', ['1+2', '3', '-(4*2)', 'True*B4', 'B4 + False', 'B4 + x', 'abs(B4)', 'B4 //', 'B4 % 2'])
+def test_invalid_expressions_raise(expression):
+    with pytest.raises(ValueError):
+        ImgIndex(expression)
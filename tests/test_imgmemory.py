@@ -0,0 +1,73 @@
+import time
+import threading
+import numpy as np
+import pytest
+from imgmemory import ImgMemoryCache
+from imgspectral import ImgSpectral
+
+
+def test_lru_budget_evicts_oldest():
+    memory = ImgMemoryCache(budget=3000)
+    for key in 'abc':
+        memory.put(key, np.zeros(100))
+    memory.get('a')
+    memory.put('d', np.zeros(100))
+    assert memory.keys() == ['c', 'a', 'd']
+    assert memory.nbytes == 2400 and memory.snapshot()['evictions'] == 1
+    memory.put('e', np.zeros(1000))
+    assert not 'e' in memory and memory.nbytes == 2400
+    assert memory.evict(800) == 1600 and memory.keys() == ['d']
+
+
+def test_fetch_loads_once_per_key():
+    memory = ImgMemoryCache()
+    calls = []
+    start = threading.Barrier(8)
+    def load():
+        calls.append(1)
+        return np.ones(10)
+    def worker():
+        start.wait()
+        memory.fetch('key', load)
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1 and memory.snapshot()['entries'] == 1
+
+
+@pytest.fixture
+def shared(monkeypatch):
+    memory = ImgMemoryCache(budget=10*1024**2)
+    monkeypatch.setattr(ImgSpectral, 'memoryCache', memory)
+    return memory
+
+
+def test_bands_group_is_loaded_once_across_scenes(makeScene, gdal, rng, shared):
+    path = makeScene({'4' : rng.integers(1, 60000, (40, 48)).astype(np.uint16)})
+    for dataset in gdal.datasets.values():
+        read = dataset.ReadAsArray
+        dataset.ReadAsArray = lambda *args, read=read, **kw: time.sleep(.05) or read(*args, **kw)
+    start = threading.Barrier(4)
+    results = []
+    def worker():
+        start.wait()
+        results.append(ImgSpectral(path, 4, False).band(4))
+    threads = [threading.Thread(target=worker) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(dataset.reads for dataset in gdal.datasets.values()) == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_shared_groups_do_not_hold_gdal_handles(makeScene, gdal, rng, shared):
+    path = makeScene({'4' : rng.integers(1, 60000, (40, 48)).astype(np.uint16)})
+    img = ImgSpectral(path, 4, False)
+    band = img.band(4)
+    assert band._ImgBand__dataset is None
+    assert band.dataset is gdal.datasets[band.paths[0]]
+    img.close()
+    assert band._ImgBand__dataset is None and img.datasets == {}
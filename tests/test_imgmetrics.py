@@ -0,0 +1,73 @@
+import gc
+import numpy as np
+import pytest
+from imgmetrics import ImgMetrics
+from imgspectral import ImgSpectral
+from multispectral import Multispectral
+
+
+def test_peak_allocation_tracks_live_arrays():
+    metrics = ImgMetrics()
+    a = np.zeros(1000)
+    b = np.zeros(500)
+    ImgMetrics.allocated(metrics, a)
+    ImgMetrics.allocated(metrics, b)
+    assert metrics.snapshot()['liveAllocation'] == 12000
+    del a
+    gc.collect()
+    c = np.zeros(100)
+    ImgMetrics.allocated(metrics, c)
+    snapshot = metrics.snapshot()
+    assert snapshot['liveAllocation'] == 4800
+    assert snapshot['peakAllocation'] == 12000
+
+
+@pytest.mark.parametrize('cls', [ImgSpectral, Multispectral])
+def test_decoder_counts_source_window_bytes(makeScene, gdal, rng, monkeypatch, cls):
+    bands = {band : rng.integers(1, 60000, (64, 96)).astype(np.uint16) for band in '2345'}
+    path = makeScene(bands)
+    metrics = ImgMetrics()
+    monkeypatch.setattr(cls, 'metrics', metrics)
+    buffers = []
+    for dataset in gdal.datasets.values():
+        read = dataset.ReadAsArray
+        dataset.ReadAsArray = lambda *args, read=read, **kw: buffers.append(kw.get('buf_xsize')) or read(*args, **kw)
+    if cls is ImgSpectral:
+        monkeypatch.setattr(ImgSpectral, 'loadStrategy', 'decoder')
+        ImgSpectral(path, 4, False).band(2)
+        expected = 64*96*2
+    else:
+        img = Multispectral(path, 4, False)
+        img.loadEngine = 'decoder'
+        img.vnir()
+        expected = 4*64*96*2
+    assert len(buffers) > 0 and all(buf == 24 for buf in buffers)
+    assert metrics.snapshot()['counters']['gdal.bytesRead'] == expected
+
+
+def test_legacy_engine_is_instrumented(makeScene, rng, monkeypatch):
+    bands = {band : rng.integers(1, 60000, (40, 48)).astype(np.uint16) for band in '2345'}
+    metrics = ImgMetrics()
+    monkeypatch.setattr(Multispectral, 'metrics', metrics)
+    img = Multispectral(makeScene(bands), 4, False)
+    img.loadEngine = 'legacy'
+    img.vnir()
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['gdal.bytesRead'] == 4*40*48*2
+    assert snapshot['stages']['decode']['count'] > 0 and 'reduce' in snapshot['stages']
+
+
+def test_cold_cache_reads_count_misses(makeScene, gdal, rng, monkeypatch):
+    bands = {band : rng.integers(1, 60000, (40, 48)).astype(np.uint16) for band in '45'}
+    path = makeScene(bands)
+    metrics = ImgMetrics()
+    monkeypatch.setattr(ImgSpectral, 'metrics', metrics)
+    misses = lambda: metrics.snapshot()['counters'].get('cache.miss', 0)
+    ImgSpectral(path, 4, True).index('(B5 - B4)/(B5 + B4)')
+    assert misses() == 1
+    # El subset busca primero en el cache de la escena completa y luego en el suyo
+    ImgSpectral(path, 4, True).subset((0, 0, 20, 20), 'pixel').band(4)
+    assert misses() == 3
+    monkeypatch.setattr(ImgSpectral, 'pyramid', False)
+    ImgSpectral(path, 2, True).band(5)
+    assert misses() == 4 and 'cache.hit' not in metrics.snapshot()['counters']
@@ -0,0 +1,274 @@
+import asyncio
+import pickle
+import threading
+import numpy as np
+import pytest
+from imgspectral import ImgSpectral, ImgBand, ImgSceneHandle, LazyImgBand
+from imgcache import ImgCache
+from imgcatalog import ImgCatalog
+
+
+@pytest.fixture
+def landsat(makeScene, rng):
+    bands = {band : rng.integers(1, 60000, (160, 240)).astype(np.uint16) for band in '12345'}
+    return makeScene(bands), bands
+
+
+def test_store_saturates_integer_dtypes():
+    data = np.array([-3.4, 0.6, 70000.0, 12.5])
+    np.testing.assert_array_equal(ImgBand.__store__(data, np.uint16), [0, 1, 65535, 12])
+    np.testing.assert_array_equal(ImgBand.__store__(np.array([-1, 300]), np.uint8), [0, 255])
+
+
+def test_pyramid_levels_round_once(landsat, monkeypatch):
+    path, bands = landsat
+    monkeypatch.setattr(ImgSpectral, 'dtype', np.uint16)
+    ImgSpectral(path, 2, True).buildPyramid([4], [2, 4, 8])
+    pyramid = ImgSpectral(path, 8, True).band(4)
+    direct = ImgSpectral(path, 8, False).band(4)
+    assert pyramid.dtype == np.uint16
+    np.testing.assert_array_equal(pyramid, direct)
+
+
+@pytest.mark.parametrize('subset', [(-8, 0, 40, 40), (0, -1, 40, 40), (240, 0, 40, 40), (300, 10, 8, 8), (0, 158, 8, 8)])
+def test_pixel_subset_out_of_raster_raises(landsat, subset):
+    path, bands = landsat
+    with pytest.raises(ValueError, match='out of raster bounds'):
+        ImgSpectral(path, 4, False).subset(subset, 'pixel').band(4)
+
+
+@pytest.mark.parametrize('subset', [(200, 120, 39, 39), (200, 120, 80, 80)])
+def test_pixel_subset_is_clamped_to_raster(landsat, subset):
+    path, bands = landsat
+    band = ImgSpectral(path, 4, False).subset(subset, 'pixel').band(4)
+    assert band.shape == (10, 10)
+    expected = bands['4'][120:160, 200:240].reshape((10, 4, 10, 4)).mean(axis=(1, 3))
+    np.testing.assert_allclose(band, expected)
+
+
+@pytest.mark.parametrize('bands', [[4], [4, 5]])
+def test_tall_pixel_subset_spans_several_load_blocks(makeScene, rng, bands):
+    # 1250000/1000 = 1250 filas por bloque, el subset de 2000 filas necesita dos bloques
+    arrays = {str(band) : rng.integers(1, 60000, (3000, 1000)).astype(np.uint16) for band in bands}
+    path = makeScene(arrays, name='tall')
+    data = ImgSpectral(path, 4, False).subset((0, 100, 1000, 2000), 'pixel').bandsGroup(bands)
+    assert data.shape[0:2] == (500, 250)
+    for i, band in enumerate(bands):
+        expected = arrays[str(band)][100:2100].reshape((500, 4, 250, 4)).mean(axis=(1, 3))
+        np.testing.assert_allclose(np.asarray(data).reshape((500, 250, -1))[:, :, i], expected)
+
+
+def test_index_is_computed_blockwise(landsat):
+    path, bands = landsat
+    index = ImgSpectral(path, 4, False).index('(B5 - B4)/(B5 + B4)', blockRows=3)
+    b4 = bands['4'].reshape((40, 4, 60, 4)).mean(axis=(1, 3))
+    b5 = bands['5'].reshape((40, 4, 60, 4)).mean(axis=(1, 3))
+    np.testing.assert_allclose(index, (b5 - b4)/(b5 + b4), rtol=1e-5)
+
+
+def test_async_loads_of_disjoint_groups_run_in_parallel(landsat, gdal):
+    path, bands = landsat
+    # Cada banda espera a que la otra empiece a leerse: si las cargas se serializan la barrera se rompe
+    barrier = threading.Barrier(2, timeout=5)
+    for dataset in gdal.datasets.values():
+        read = dataset.ReadAsArray
+        dataset.ReadAsArray = lambda *args, read=read, **kw: barrier.wait() is None or read(*args, **kw)
+    img = ImgSpectral(path, 4, False)
+
+    async def load():
+        return await asyncio.gather(img.aband(4), img.subset((0, 0, 80, 80), 'pixel').aband(5))
+
+    b4, b5 = asyncio.run(load())
+    np.testing.assert_allclose(b4, bands['4'].reshape((40, 4, 60, 4)).mean(axis=(1, 3)))
+    np.testing.assert_allclose(b5, bands['5'][:80, :80].reshape((20, 4, 20, 4)).mean(axis=(1, 3)))
+
+
+def test_closing_a_subset_keeps_parent_datasets(landsat, gdal):
+    path, bands = landsat
+    img = ImgSpectral(path, 4, False)
+    img.band(4)
+    with img.subset((0, 0, 80, 80), 'pixel') as sub:
+        sub.band(4)
+    assert '4' in img.datasets
+    img.band(5)
+    img.close()
+    assert img.datasets == {}
+
+
+@pytest.fixture
+def mixed(makeScene, rng):
+    # Banda 5 a 20 m y banda 4 a 10 m sobre la misma extension
+    b4 = rng.integers(1, 60000, (160, 240)).astype(np.uint16)
+    b5 = rng.integers(1, 60000, (80, 120)).astype(np.uint16)
+    path = makeScene({'4' : b4, '5' : (b5, {'gt' : (500000.0, 20.0, 0.0, 1000000.0, 0.0, -20.0)})}, name='mixed')
+    return path, b4.reshape((40, 4, 60, 4)).mean(axis=(1, 3)), b5.reshape((40, 2, 60, 2)).mean(axis=(1, 3))
+
+
+def test_mixed_resolution_group_uses_finest_grid(mixed):
+    path, b4, b5 = mixed
+    group = ImgSpectral(path, 4, False).bandsGroup([5, 4])
+    assert group.shape == (40, 60, 2)
+    np.testing.assert_allclose(group[:, :, 0], b5)
+    np.testing.assert_allclose(group[:, :, 1], b4)
+
+
+def test_mixed_resolution_index_survives_close(mixed):
+    path, b4, b5 = mixed
+    img = ImgSpectral(path, 4, False)
+    index = img.index('(B5 - B4)/(B5 + B4)')
+    np.testing.assert_allclose(index, (b5 - b4)/(b5 + b4), rtol=1e-5)
+    img.close()
+    assert index.dataset.GetDescription().endswith('LC08_B4.tif')
+
+
+@pytest.fixture
+def coarse(makeScene, rng):
+    # Banda 1 a 60 m con una rampa de 50 DN por pixel en filas, banda 4 a 10 m; el ancho hace
+    # que los bloques de carga (520 filas) corten la banda de 60 m en fracciones de pixel
+    b4 = rng.integers(1, 60000, (1200, 2400)).astype(np.uint16)
+    b1 = (50*np.arange(200)[:, None] + np.arange(400)[None, :]%7).astype(np.uint16)
+    path = makeScene({'4' : b4, '1' : (b1, {'gt' : (500000.0, 60.0, 0.0, 1000000.0, 0.0, -60.0)})}, name='coarse')
+    # Promedio por area exacto: llevar la banda a 10 m y promediar 8x8
+    expected = np.repeat(np.repeat(b1.astype(np.float64), 6, axis=0), 6, axis=1).reshape((150, 8, 300, 8)).mean(axis=(1, 3))
+    return path, expected
+
+
+def test_fractional_band_windows_are_registered(coarse):
+    path, expected = coarse
+    group = ImgSpectral(path, 8, False).bandsGroup([1, 4])
+    np.testing.assert_allclose(group[:, :, 0], expected, atol=1e-6)
+
+
+def test_fractional_band_windows_in_blocks_and_chips(coarse):
+    path, expected = coarse
+    img = ImgSpectral(path, 8, False)
+    blocks = np.concatenate([block[:, :, 0] for row, col, gt, block in img.iterBlocks([1, 4], blockRows=7)])
+    np.testing.assert_allclose(blocks, expected, atol=1e-6)
+    # Centro (x, y) y tamaño (ancho, alto) en pixeles de 10 m: ventana de filas 13-53 y columnas 13-69
+    chip = img.chips([4, 1], [(328, 264)], (448, 320), 'pixel')[0]
+    np.testing.assert_allclose(chip[:, :, 1], expected[13:53, 13:69], atol=1e-6)
+
+
+def test_batch_workers_use_the_parent_cache_settings(makeScene, rng, tmp_path, monkeypatch):
+    path = makeScene({'4' : rng.integers(1, 60000, (40, 48)).astype(np.uint16)})
+    monkeypatch.setattr(ImgCache, 'root', str(tmp_path/'root'))
+    monkeypatch.setattr(ImgCache, 'budget', 10**9)
+    monkeypatch.setattr(ImgCatalog, 'persist', False)
+    monkeypatch.setattr(ImgSpectral, 'dtype', np.uint16)
+    config = pickle.loads(pickle.dumps(ImgSpectral.__batchConfig__()))
+    for (cls, name), value in config.items():
+        monkeypatch.setattr(cls, name, value)
+    # Un proceso nuevo parte de los valores por defecto de cada clase
+    monkeypatch.setattr(ImgCache, 'root', None)
+    monkeypatch.setattr(ImgCache, 'budget', None)
+    monkeypatch.setattr(ImgCatalog, 'persist', True)
+    monkeypatch.setattr(ImgSpectral, 'dtype', np.float64)
+    handle = ImgSpectral.__batchScene__(ImgSceneHandle(path, [4], 4), config)
+    assert handle.cachePath.startswith(str(tmp_path/'root')) and handle.dtype == np.uint16
+    assert ImgCache.budget == 10**9 and not ImgCatalog.persist
+    assert not (tmp_path/'scene'/ImgCatalog.fileName).exists()
+
+
+def reads(gdal):
+    return sum(dataset.reads for dataset in gdal.datasets.values())
+
+
+def test_chips_read_overlapping_windows_once(landsat, gdal):
+    path, bands = landsat
+    img = ImgSpectral(path, 4, False)
+    # Dos chips superpuestos en las filas 16-26 y uno separado en las filas 31-39
+    centers = [(80, 80), (96, 88), (200, 140)]
+    before = reads(gdal)
+    chips = img.chips([4, 5], centers, (32, 32), 'pixel')
+    assert chips.shape == (3, 8, 8, 2) and reads(gdal) - before == 2*2
+    before = reads(gdal)
+    for chip, (row, col) in zip(chips, [(16, 16), (18, 20), (31, 46)]):
+        subset = ImgSpectral(path, 4, False).subset((col*4, row*4, 32, 32), 'pixel').bandsGroup([4, 5])
+        np.testing.assert_allclose(chip, subset)
+    assert reads(gdal) - before == 3*2
+
+
+def test_chips_outside_the_scene_are_filled(landsat, monkeypatch):
+    path, bands = landsat
+    full = ImgSpectral(path, 4, False).band(4)
+    chips = ImgSpectral(path, 4, False).chips([4], [(0, 0), (1000, 1000)], (32, 32), 'pixel')
+    assert np.isnan(chips[0, :4]).all() and np.isnan(chips[0, :, :4]).all()
+    np.testing.assert_allclose(chips[0, 4:, 4:, 0], full[0:4, 0:4])
+    assert np.isnan(chips[1]).all()
+    monkeypatch.setattr(ImgSpectral, 'dtype', np.uint16)
+    chips = ImgSpectral(path, 4, False).chips([4], [(0, 0)], (32, 32), 'pixel')
+    assert chips.dtype == np.uint16 and (chips[0, :4] == 0).all()
+
+
+def test_unstacked_chips_keep_their_sizes(landsat):
+    path, bands = landsat
+    img = ImgSpectral(path, 4, False)
+    full = img.bandsGroup([4, 5])
+    centers, sizes = [(200, 140), (80, 80)], [(32, 16), (16, 48)]
+    with pytest.raises(ValueError):
+        img.chips([4, 5], centers, sizes, 'pixel')
+    chips = {i : (gt, chip) for i, gt, chip in img.chips([4, 5], centers, sizes, 'pixel', stack=False)}
+    gt, chip = chips[0]
+    assert chip.shape == (4, 8, 2) and gt == (500000.0 + 46*40, 40.0, 0.0, 1000000.0 - 33*40, 0.0, -40.0)
+    np.testing.assert_allclose(chip, full[33:37, 46:54])
+    gt, chip = chips[1]
+    assert chip.shape == (12, 4, 2)
+    np.testing.assert_allclose(chip, full[14:26, 18:22])
+
+
+def test_lazy_band_slices_fill_only_their_blocks(landsat, gdal, monkeypatch):
+    path, bands = landsat
+    monkeypatch.setattr(LazyImgBand, 'blockShape', (8, 8))
+    full = ImgSpectral(path, 4, False).band(4)
+    lazy = ImgSpectral(path, 4, False).lazyBand(4)
+    assert lazy.filled.shape == (5, 8) and not lazy.filled.any()
+    np.testing.assert_allclose(lazy[-3], full[-3])
+    assert lazy.filled[4].all() and lazy.filled.sum() == 8
+    # Las filas 3-10 y todas las columnas, recorridas hacia atras
+    np.testing.assert_allclose(lazy[10:2:-3, ::-7], full[10:2:-3, ::-7])
+    assert lazy.filled[0:2].all() and not lazy.filled[2:4].any()
+    np.testing.assert_allclose(lazy[-20:-12:2, -1], full[-20:-12:2, -1])
+    assert lazy.filled[2:4, 7].all() and not lazy.filled[2:4, 0:7].any()
+    before = reads(gdal)
+    assert lazy[5:5].shape == (0, 60) and lazy[30:2:1].size == 0
+    np.testing.assert_allclose(lazy[2:9:-1], full[2:9:-1])
+    np.testing.assert_allclose(lazy[-1:-4:-1, 60:0:-2], full[-1:-4:-1, 60:0:-2])
+    assert reads(gdal) == before
+    np.testing.assert_allclose(np.asarray(lazy), full)
+    assert lazy.filled.all()
+
+
+def test_lazy_groups_fill_every_band(landsat, gdal, monkeypatch):
+    path, bands = landsat
+    monkeypatch.setattr(LazyImgBand, 'blockShape', (8, 8))
+    full = ImgSpectral(path, 4, False).bandsGroup([4, 5])
+    lazy = ImgSpectral(path, 4, False).lazyBandsGroup([4, 5])
+    assert lazy.shape == (40, 60, 2) and lazy.filled.shape == (5, 8)
+    np.testing.assert_allclose(lazy[2:10, 3], full[2:10, 3])
+    assert lazy.filled[0:2, 0].all() and lazy.filled.sum() == 2
+    np.testing.assert_allclose(lazy[-1, -2:, 1], full[-1, -2:, 1])
+    assert lazy.filled.sum() == 3
+    before = reads(gdal)
+    np.testing.assert_allclose(lazy[..., 1], full[..., 1])
+    assert lazy.filled.all() and reads(gdal) > before
+    before = reads(gdal)
+    np.testing.assert_allclose(lazy.load(), full)
+    assert reads(gdal) == before
+
+
+def test_cache_hit_rebuilds_geometry_without_opening_datasets(landsat, gdal):
+    path, bands = landsat
+    direct = ImgSpectral(path, 4, True)
+    expected = [direct.bandsGroup([4, 5]), direct.band(4), direct.index('(B5 - B4)/(B5 + B4)')]
+    gdal.opened.clear()
+    img = ImgSpectral(path, 4, True)
+    loaded = [img.bandsGroup([4, 5]), img.band(4), img.index('(B5 - B4)/(B5 + B4)')]
+    assert gdal.opened == [] and gdal.osr.transforms == 0
+    for data, reference in zip(loaded, expected):
+        np.testing.assert_array_equal(data, reference)
+        assert data.describe() == reference.describe()
+    # Las transformaciones de coordenadas se crean al primer uso y se reutilizan
+    group = loaded[0]
+    assert group.transToXY is group.transToXY and gdal.osr.transforms == 2
+    band = loaded[1]
+    assert band.dataset is gdal.datasets[band.paths[0]] and gdal.opened == [band.paths[0]]
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import pytest
+from imgstats import ImgStats
+
+
+@pytest.mark.parametrize('q', [0.02, 0.07, 0.5, 0.93, 0.98])
+def test_histogram_quantile_matches_numpy(rng, q):
+    values = rng.random((300, 200))
+    hist, edges, _max = ImgStats.histogram(values, 0, 1, bins=4096)
+    assert ImgStats.quantile(hist[0], edges, q) == pytest.approx(np.quantile(values, q), abs=1/4096)
+    assert _max == values.max()
+
+
+def test_chunked_histogram_matches_single_pass(rng, monkeypatch):
+    values = rng.random((120, 80, 3))
+    whole = ImgStats.histogram(values, 0, 1, bins=256)[0]
+    monkeypatch.setattr(ImgStats, 'chunkPixels', 500)
+    np.testing.assert_array_equal(ImgStats.histogram(values, 0, 1, bins=256)[0], whole)
+
+
+def test_clip_points_per_channel(rng):
+    values = np.dstack((rng.random((100, 100))*.5, .5 + rng.random((100, 100))*.5))
+    points = ImgStats.clipPoints(values, .93)
+    assert points['low'] == pytest.approx(np.quantile(values[:,:,0], .07), abs=1e-3)
+    assert points['high'] == pytest.approx(np.quantile(values[:,:,1], .93), abs=1e-3)
+
+
+def test_range_ignores_nan_floor():
+    values = np.array([[-9999, 5, 7], [3, 3, 10]], dtype=np.float64)
+    stats = ImgStats.range(values)
+    assert (stats['min'], stats['max'], stats['count']) == (3, 10, 5)
+
+
+def test_saved_stats_follow_their_source(tmp_path):
+    source, path = tmp_path/'vnir.npy', tmp_path/'vnir.rgb.json'
+    source.write_bytes(b'a')
+    ImgStats.save(path, {'min' : 1.0, 'max' : 2.0}, source)
+    assert ImgStats.load(path, source) == {'min' : 1.0, 'max' : 2.0}
+    source.write_bytes(b'ab')
+    assert ImgStats.load(path, source) is None
+    assert ImgStats.load(path) is None
+
+
+def test_unreadable_stats_are_a_miss(tmp_path):
+    path = tmp_path/'group.stats.json'
+    path.write_text('{"min": 1.0, "ma')
+    assert ImgStats.load(path) is None
+    assert sorted(os.listdir(tmp_path)) == ['group.stats.json']
@@ -0,0 +1,77 @@
+import json
+import numpy as np
+import pytest
+from imgtimeseries import ImgTimeSeries
+
+
+def reduce(band):
+    rows, cols = int(band.shape[0]/2), int(band.shape[1]/2)
+    return band[:rows*2, :cols*2].reshape((rows, 2, cols, 2)).mean(axis=(1, 3))
+
+
+@pytest.fixture
+def scenes(makeScene, rng):
+    def make(name, x = 500000.0, shape = (40, 48), **options):
+        bands = {band : rng.integers(1, 1000, shape).astype(np.float64) for band in '45'}
+        gt = (x, 10.0, 0.0, 1000000.0, 0.0, -10.0)
+        return makeScene({band : (arr, dict(options, gt=gt)) for band, arr in bands.items()}, name=name), bands
+    return make
+
+
+def test_scenes_are_aligned_on_the_first_grid(scenes, tmp_path):
+    first, a = scenes('a')
+    shifted, b = scenes('b', 500040.0)
+    resampled, c = scenes('c', 500010.0)
+    ts = ImgTimeSeries.build(tmp_path/'ts.npy', [first, shifted, resampled], [4, 5], resizeFactor=2)
+    assert ts.shape == (3, 20, 24, 2) and ts.loaded == [True, True, True]
+    np.testing.assert_allclose(ts.scene(0)[:, :, 1], reduce(a['5']), rtol=1e-6)
+    assert np.isnan(ts.scene(1)[:, :2]).all()
+    np.testing.assert_allclose(ts.scene(1)[:, 2:, 0], reduce(b['4'][:, :44]), rtol=1e-6)
+    assert np.isnan(ts.scene(2)[:, 0]).all() and not np.isnan(ts.scene(2)[:, 1:]).any()
+    stats = ts.stats(['count'])
+    assert stats['count'][0, 0].tolist() == [1, 1] and stats['count'][0, 5].tolist() == [3, 3]
+
+
+def test_nodata_pixels_are_masked(scenes, tmp_path):
+    first, a = scenes('a', nodata=-9999.0)
+    second, b = scenes('b')
+    a['4'][0:4, 0:4] = -9999.0
+    b['5'][10:12, 20:22] = 0
+    ts = ImgTimeSeries.build(tmp_path/'ts.npy', [first, second], [4, 5], resizeFactor=2)
+    assert np.isnan(ts.scene(0)[0:2, 0:2, 0]).all() and not np.isnan(ts.scene(0)[0:2, 0:2, 1]).any()
+    assert np.isnan(ts.scene(1)[5, 10, 1]) and not np.isnan(ts.scene(1)[5, 10, 0])
+    assert np.isnan(ts.scene(1)).sum() == 1
+
+
+def test_failed_scene_is_recorded(scenes, makeScene, rng, tmp_path):
+    first, a = scenes('a')
+    broken = makeScene({'4' : rng.random((40, 48))}, name='broken')
+    with pytest.warns(RuntimeWarning, match='not loaded'):
+        ts = ImgTimeSeries.build(tmp_path/'ts.npy', [first, broken], [4, 5], resizeFactor=2)
+    assert ts.loaded == [True, False] and ts.errors[0] is None
+    assert 'not Found' in ts.errors[1] and np.isnan(ts.scene(1)).all()
+    meta = json.loads((tmp_path/'ts.npy.json').read_text())
+    assert meta['errors'] == ts.errors
+
+
+def test_tall_pixel_subset_is_loaded(makeScene, rng, tmp_path):
+    arrays = [{band : rng.integers(1, 1000, (3000, 1000)).astype(np.float64) for band in '45'} for i in range(2)]
+    paths = [makeScene(bands, name='tall%d' % i) for i, bands in enumerate(arrays)]
+    ts = ImgTimeSeries.build(tmp_path/'ts.npy', paths, [4, 5], (0, 100, 1000, 2000), 'pixel', resizeFactor=4)
+    assert ts.loaded == [True, True] and ts.shape == (2, 500, 250, 2)
+    expected = arrays[1]['5'][100:2100].reshape((500, 4, 250, 4)).mean(axis=(1, 3))
+    np.testing.assert_allclose(ts.scene(1)[:, :, 1], expected, rtol=1e-6)
+
+
+@pytest.mark.parametrize('factor', [2, 3])
+def test_latlon_subset_with_any_factor(scenes, tmp_path, factor):
+    first, a = scenes('a', shape=(120, 120))
+    # Centro en el pixel (fila 50, columna 60) con la transformacion identidad de FakeOsr
+    subset = (1000000.0 - 505.0, 500000.0 + 605.0, 300, 200)
+    ts = ImgTimeSeries.build(tmp_path/'ts.npy', [first], [4], subset, resizeFactor=factor)
+    rows, cols = ts.shape[1:3]
+    assert rows*factor >= 20 and cols*factor >= 30 and ts.loaded == [True]
+    x, y = int(round((ts.geoTransform[0] - 500000.0)/10)), int(round((1000000.0 - ts.geoTransform[3])/10))
+    assert abs(x + cols*factor/2 - 60) <= 1 and abs(y + rows*factor/2 - 50) <= 1
+    expected = a['4'][y : y + rows*factor, x : x + cols*factor].reshape((rows, factor, cols, factor)).mean(axis=(1, 3))
+    np.testing.assert_allclose(ts.scene(0)[:, :, 0], expected, rtol=1e-6)
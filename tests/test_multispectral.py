@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from multispectral import Multispectral
+
+
+@pytest.fixture
+def landsat(makeScene, rng):
+    bands = {band : rng.integers(1, 60000, (203, 317)).astype(np.uint16) for band in '123458'}
+    return makeScene(bands), bands
+
+
+@pytest.mark.parametrize('factor', [1, 3, 8])
+def test_block_engine_matches_legacy(landsat, factor):
+    path, bands = landsat
+    block = Multispectral(path, factor, False)
+    legacy = Multispectral(path, factor, False)
+    legacy.loadEngine = 'legacy'
+    assert block.vnir().shape == (int(203/factor), int(317/factor), 4)
+    np.testing.assert_allclose(block.vnir(), legacy.vnir())
+
+
+def test_block_engine_with_workers(landsat):
+    path, bands = landsat
+    serial = Multispectral(path, 4, False).vnir()
+    parallel = Multispectral(path, 4, False)
+    parallel.workers = 4
+    np.testing.assert_array_equal(parallel.vnir(), serial)
+    expected = bands['2'][:200, :316].reshape((50, 4, 79, 4)).mean(axis=(1, 3))
+    np.testing.assert_allclose(serial[:, :, 0], expected)
+
+
+@pytest.mark.parametrize('engine', ['block', 'decoder'])
+def test_iter_blocks_uses_load_engine(landsat, gdal, engine):
+    path, bands = landsat
+    img = Multispectral(path, 4, False)
+    img.loadEngine = engine
+    calls = []
+    for dataset in gdal.datasets.values():
+        read = dataset.ReadAsArray
+        dataset.ReadAsArray = lambda *args, read=read, **kw: calls.append(kw.get('buf_xsize')) or read(*args, **kw)
+    blocks = np.concatenate([block for row, col, gt, block in img.iterBlocks([2, 3, 4, 5], blockRows=7)])
+    assert len(calls) > 0 and all((buf is None) == (engine == 'block') for buf in calls)
+    np.testing.assert_allclose(blocks, Multispectral(path, 4, False).vnir())
+
+
+def test_legacy_engine_rounds_integer_dtypes(landsat, monkeypatch):
+    path, bands = landsat
+    monkeypatch.setattr(Multispectral, 'dtype', np.uint16)
+    block = Multispectral(path, 3, False)
+    legacy = Multispectral(path, 3, False)
+    legacy.loadEngine = 'legacy'
+    assert legacy.vnir().dtype == np.uint16
+    np.testing.assert_array_equal(block.vnir(), legacy.vnir())
+
+
+def test_store_saturates_integer_dtypes():
+    data = np.array([-3.4, 0.6, 70000.0, 12.5])
+    np.testing.assert_array_equal(Multispectral.__store__(data, np.uint16), [0, 1, 65535, 12])
+
+
+def test_rgb_clip_points_follow_the_vnir_cache(landsat, monkeypatch):
+    path, bands = landsat
+    first = Multispectral(path, 4, True).rgb()
+    img = Multispectral(path, 4, True)
+    np.testing.assert_array_equal(img.rgb(), first)
+    monkeypatch.setattr(Multispectral, 'dtype', np.float32)
+    img.convertCache()
+    statsPath = img.pathCahe/'vnir.rgb.json'
+    stale = statsPath.read_text()
+    Multispectral(path, 4, True).rgb()
+    assert statsPath.read_text() != stale